@@ -1,14 +1,20 @@
+import asyncio
 import models
 import time
 import pytz
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, status
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from config import engine
+from config import engine, pool_stats
 from datetime import datetime
 from utils import logs
-from scripts.sync_table import sync_table
-from scripts.sync_table_column import selective_column_sync_table
-from scripts.combine_table_sync import combine_table_and_sync
+from functools import partial
+from scripts.sync_engine import run_plans, plan_tables, load_plans
+from scripts.verify import run_verify
+from scripts.async_engine import run_plans_async, close_pools, SYNC_ASYNC_ENGINE
+from scripts.jobs import submit_job, submit_async_job, get_job, list_jobs, JobConflict
+from scripts.metrics import latest
+from scripts.scheduler import scheduler, SYNC_SCHEDULER
 
 models.Base.metadata.create_all(bind=engine)
 
@@ -27,6 +33,14 @@ app.add_middleware(
 async def startup_event():
     # Set the timezone for the application
     datetime.now(pytz.timezone('Asia/Kolkata'))
+    if SYNC_SCHEDULER:
+        scheduler.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    scheduler.shutdown()
+    await close_pools()
 
 
 @app.middleware("http")
@@ -39,31 +53,77 @@ async def add_process_time_header(request, call_next):
 
 
 @app.get('/')
-def index():
+async def index():
     data = {'Hello': 'World'}
     logs('Hello world')
 
     return data
 
-@app.get('/sync-tables')
-def syncing_table():
-    logs("start syncing tables")
-    result = sync_table()
-    print(result)
-    return "done" if result  else "not done"
+def start_job(name, func, tables, submit=submit_job):
+    try:
+        job = submit(name, func, tables=tables)
+    except JobConflict as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail={'message': e.detail, 'job_id': e.job_id}
+        )
+    return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content=job.to_dict())
+
+
+async def start_sync_job(group):
+    logs(f"start syncing tables: {group}")
+    # the plan file is read in a worker thread, the syncs run as tasks on this event loop with SYNC_ASYNC_ENGINE
+    tables = await asyncio.to_thread(plan_tables, group)
+    if SYNC_ASYNC_ENGINE:
+        return start_job(group, partial(run_plans_async, group), tables, submit=submit_async_job)
+    return start_job(group, partial(run_plans, group), tables)
+
+
+# GET is kept for the cron jobs which call these urls
+@app.api_route('/sync-tables', methods=['GET', 'POST'])
+async def sync_tables():
+    return await start_sync_job('sync-tables')
+
+@app.api_route('/selective-column-sync-tables', methods=['GET', 'POST'])
+async def selective_column_sync_tables():
+    return await start_sync_job('selective-column-sync-tables')
+
+@app.api_route('/combine-table-and-sync', methods=['GET', 'POST'])
+async def combine_tables_and_sync():
+    return await start_sync_job('combine-table-and-sync')
+
+# checksums the target table of a plan against its source, repair=false only reports the differences
+@app.post('/verify-table/{plan_name}')
+def verify_table(plan_name: str, repair: bool = True):
+    plans, _ = load_plans()
+    plan = next((plan for plan in plans if plan.name == plan_name), None)
+    if not plan:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Sync plan not found")
+    logs(f"start verifying table: {plan.target_table}")
+    return start_job(f"verify-{plan_name}", partial(run_verify, plan_name, repair), [plan.target_table])
+
+# the intervals of the scheduled syncs, adapted after every run
+@app.get('/sync-schedule')
+def sync_schedule():
+    return scheduler.status()
 
-@app.get('/selective-column-sync-tables')
-def syncing_table():
-    logs("start syncing tables")
-    result = selective_column_sync_table()
-    print(result)
-    return "done" if result  else "not done"
+# per table and phase timings of the syncs in the prometheus format
+@app.get('/metrics')
+def metrics():
+    body, content_type = latest()
+    return Response(content=body, headers={'Content-Type': content_type})
 
-@app.get('/combine-table-and-sync')
-def syncing_table():
-    logs("start syncing tables")
-    result = combine_table_and_sync()
-    print(result)
-    return "done" if result  else "not done"
+@app.get('/pool-stats')
+def connection_pool_stats():
+    return pool_stats()
 
+@app.get('/sync-jobs')
+async def sync_jobs():
+    return list_jobs()
 
+@app.get('/sync-jobs/{job_id}')
+async def sync_job_status(job_id: str):
+    job = get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job.to_dict()
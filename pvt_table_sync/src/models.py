@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Float, func
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Float, func
 from config import Base
 
 class TowerConfig(Base):
@@ -38,4 +38,13 @@ class TariffConfig(Base):
     eb_full_tariff = Column(String(100), nullable=False)
     dg_full_tariff = Column(String(100))
     timestamp = Column(DateTime, nullable=False)
-    updated_by = Column(String(70),default="script")
\ No newline at end of file
+    updated_by = Column(String(70),default="script")
+
+
+class SyncFence(Base):
+    # the newest lease token which wrote a table (or a shard of it), see scripts/leases.py
+    __tablename__ = 'sync_fence'
+
+    lease_name = Column(String(300), primary_key=True)
+    token = Column(BigInteger, nullable=False)
+    updated_at = Column(DateTime, nullable=False, server_default=func.now())
@@ -0,0 +1,444 @@
+import asyncio
+import io
+import os
+import time
+from contextlib import asynccontextmanager
+from functools import partial
+from config import (
+    engine, mysql_engines, async_redis_con_gp, SYNC_BATCH_SIZE, STREAM_WRITE_TIMEOUT, SYNC_MAX_WORKERS,
+    PG_POOL_SIZE, MYSQL_POOL_SIZE, POOL_RECYCLE
+)
+from utils import logs, row_counts
+from scripts.executor import source_semaphore
+from scripts.jobs import SyncJob, claim_table, release_table
+from scripts.leases import acquire, FENCE_QUERY, LeaseLost
+from scripts.loader import quote, copy_buffer, merge_query, insert_defaults
+from scripts.metrics import Phase, observe, estimate_bytes, observe_run
+from scripts.predicates import add_condition
+from scripts.sync_engine import select_plans, sync_plan, sync_fanout
+from scripts.sync_state import (
+    watermark_clause, max_watermark, set_watermark, fingerprint_key, compare_fingerprints
+)
+
+
+"""
+    this code runs the syncs as coroutines on the event loop of the api, so many table syncs
+    of one process wait on mysql, postgres and redis at the same time without a thread each
+    * the first table is streamed with aiomysql by an extract task which puts the batches on a
+      small queue, the sync takes them from the queue, dedupes them, drops the unchanged rows
+      with the async redis client and COPYs the rest into postgres with asyncpg, so the next
+      batch is read while one is written
+    * the cpu work of a batch (dedupe, fingerprints, COPY buffer) runs in a worker thread,
+      so a big batch doesn't hold the event loop and / and the status endpoints answer at once
+    * only the plans read by one query and written with COPY run natively, a plan with
+      supporting tables on another server or in a snapshot, shards, several readers, a checkpoint,
+      targets or the orm strategy runs the threaded sync_engine in a worker thread
+    * the redis lease, watermark and row count calls are a few per run and go to a worker thread
+    * the source database limits of scripts/executor.py are shared with the threaded runs
+    set SYNC_ASYNC_ENGINE=1 to run the api syncs with it, needs aiomysql and asyncpg
+"""
+
+# run the syncs started from the api on the event loop instead of the job threads
+SYNC_ASYNC_ENGINE = os.environ.get('SYNC_ASYNC_ENGINE', '').lower() in ('1', 'true', 'yes')
+# batches read ahead of the sync by the extract task
+SYNC_ASYNC_QUEUE_BATCHES = int(os.environ.get('SYNC_ASYNC_QUEUE_BATCHES', 2))
+# seconds between two tries to take a busy source database
+SOURCE_POLL_SECONDS = 0.05
+
+DONE = object()
+ASYNC_FENCE_QUERY = FENCE_QUERY % ('$1', '$2')
+
+pools = {}
+pools_lock = asyncio.Lock()
+redis_client = None
+
+
+async def pg_pool():
+    """Return the asyncpg pool of the target database, it is created on first use."""
+    import asyncpg
+
+    async with pools_lock:
+        if 'postgres' not in pools:
+            url = engine.url
+            pools['postgres'] = await asyncpg.create_pool(
+                host=url.host or None, port=url.port, user=url.username, password=url.password,
+                database=url.database, min_size=1, max_size=PG_POOL_SIZE,
+                max_inactive_connection_lifetime=POOL_RECYCLE
+            )
+        return pools['postgres']
+
+
+async def mysql_pool(server='legacy'):
+    """Return the aiomysql pool of a source server, it is created on first use."""
+    import aiomysql
+
+    async with pools_lock:
+        if server not in pools:
+            url = mysql_engines[server].url
+            pools[server] = await aiomysql.create_pool(
+                host=url.host, port=url.port or 3306, user=url.username, password=url.password or '',
+                minsize=1, maxsize=MYSQL_POOL_SIZE, pool_recycle=POOL_RECYCLE, autocommit=True
+            )
+        return pools[server]
+
+
+def get_redis():
+    global redis_client
+    if redis_client is None:
+        redis_client = async_redis_con_gp(11)
+    return redis_client
+
+
+async def close_pools():
+    """Close the connection pools, call it when the event loop stops."""
+    global redis_client
+    async with pools_lock:
+        for server, pool in list(pools.items()):
+            if server == 'postgres':
+                await pool.close()
+            else:
+                pool.close()
+                await pool.wait_closed()
+            del pools[server]
+    if redis_client is not None:
+        await redis_client.close()
+        redis_client = None
+
+
+async def stream_rows(query, params=(), server='legacy', batch_size=SYNC_BATCH_SIZE):
+    """
+        Read a query result in fixed size batches of dictionaries, the async twin of config.stream_db_data.
+
+        Parameters:
+        - query (str): The SELECT query.
+        - params (tuple, optional): The parameters of the query.
+        - server (str, optional): The source mysql server. Defaults to the legacy server.
+        - batch_size (int, optional): The number of rows in each batch.
+
+        Returns:
+        async generator: Yields lists of dictionaries. A connection left with unread rows is closed.
+    """
+
+    import aiomysql
+
+    pool = await mysql_pool(server)
+    con = await pool.acquire()
+    finished = False
+    try:
+        async with con.cursor() as setup:
+            await setup.execute(f'SET SESSION net_write_timeout = {STREAM_WRITE_TIMEOUT}')
+        cursor = await con.cursor(aiomysql.SSDictCursor)
+        await cursor.execute(query, params or None)
+        while True:
+            rows = await cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+        await cursor.close()
+        finished = True
+    finally:
+        if not finished:
+            # the unread rows make the connection unusable
+            con.close()
+        pool.release(con)
+
+
+async def extract(plan, query, params, batches):
+    """Put the batches of the query on the queue, then DONE, or the error which stopped the read."""
+    try:
+        started = time.perf_counter()
+        async for records in stream_rows(query, params, plan.server):
+            observe(
+                plan.target_table, 'extract', time.perf_counter() - started, rows_out=len(records),
+                bytes_fetched=estimate_bytes(records), round_trips=1
+            )
+            await batches.put(records)
+            started = time.perf_counter()
+        await batches.put(DONE)
+    except Exception as e:
+        await batches.put(e)
+
+
+async def check_fence(con, lease):
+    """Record the fencing token of the lease in the open transaction, see leases.check_fence."""
+    if lease is None or lease.token is None:
+        return
+    lease.check()
+    if await con.fetchval(ASYNC_FENCE_QUERY, lease.name, lease.token) is None:
+        raise LeaseLost(f"lease {lease.name} with token {lease.token} is older than the last writer")
+
+
+def copy_bytes(rows):
+    return io.BytesIO(copy_buffer(rows).getvalue().encode())
+
+
+async def merge_rows(rows, target_table, columns, key_column, lease=None, defaults=None):
+    """
+        Copy rows into a staging table and merge them into the target table in one transaction,
+        the asyncpg twin of loader.merge_rows.
+
+        Returns:
+        tuple: (inserted, updated) row counts.
+    """
+
+    staging_table = f'_stage_{target_table}'
+    cols = ', '.join(quote(column) for column in columns)
+    buffer = await asyncio.to_thread(copy_bytes, rows)
+
+    pool = await pg_pool()
+    async with pool.acquire() as con:
+        transaction = con.transaction()
+        await transaction.start()
+        try:
+            with Phase(target_table, 'load', rows_in=len(rows), round_trips=3) as measured:
+                await con.execute(
+                    f"CREATE TEMP TABLE {quote(staging_table)} ON COMMIT DROP AS "
+                    f"SELECT {cols} FROM {quote(target_table)} WITH NO DATA"
+                )
+                await con.copy_to_table(staging_table, source=buffer, columns=list(columns), format='text')
+                inserted, updated = await con.fetchrow(merge_query(target_table, quote(staging_table), columns, key_column, defaults))
+                measured.rows_out = inserted + updated
+            await check_fence(con, lease)
+        except BaseException:
+            await transaction.rollback()
+            raise
+        with Phase(target_table, 'commit', round_trips=1):
+            await transaction.commit()
+    return inserted, updated
+
+
+async def filter_changed(target_table, rows, key_index, columns):
+    """The async twin of sync_state.filter_changed, returns (changed rows, fingerprints)."""
+    if not rows:
+        return rows, None
+    store = fingerprint_key(target_table, columns)
+    keys = [str(row[key_index]) for row in rows]
+    saved = await get_redis().hmget(store, keys)
+    changed, fingerprints = await asyncio.to_thread(compare_fingerprints, rows, keys, saved)
+    return changed, (store, fingerprints)
+
+
+async def save_fingerprints(fingerprints):
+    if not fingerprints or not fingerprints[1]:
+        return
+    store, values = fingerprints
+    await get_redis().hset(store, mapping=values)
+
+
+async def sync_batch(plan, records, errors, job, lease):
+    """
+        Dedupe one batch of source records, drop the unchanged rows and COPY the rest.
+
+        Returns:
+        tuple: (committed, rows) where rows are the deduplicated target rows of the batch.
+    """
+
+    target_table = plan.target_table
+    lease.check()
+    with Phase(target_table, 'dedupe', rows_in=len(records)) as measured:
+        rows = await asyncio.to_thread(plan.to_rows, records)
+        measured.rows_out = len(rows)
+    if not rows:
+        if not plan.filter:
+            logs("No unique record IDs found in the fetched data.", type="warning")
+        return True, rows
+
+    changed_rows, fingerprints = rows, None
+    if plan.fingerprint_cache:
+        with Phase(target_table, 'diff', rows_in=len(rows), round_trips=1) as measured:
+            changed_rows, fingerprints = await filter_changed(
+                target_table, rows, plan.key_index, plan.target_columns
+            )
+            measured.rows_out = len(changed_rows)
+
+    job.add(rows_diffed=len(rows))
+    job.set_phase(target_table, 'load')
+
+    batch_synced = True
+    if changed_rows:
+        try:
+            inserted, updated = await merge_rows(
+                changed_rows, target_table, plan.target_columns, plan.target_key, lease,
+                insert_defaults(plan.model, plan.target_columns)
+            )
+            job.add(rows_written=inserted + updated)
+            row_counts.add(target_table, 'inserted', inserted)
+            row_counts.add(target_table, 'updated', updated)
+            logs(f"Database sync complete for {target_table}: {inserted} inserted, {updated} updated.")
+        except Exception as e:
+            errors.append(f"Error syncing data from {plan.primary['table_name']}: {str(e)}")
+            logs(f"Error syncing data from {plan.primary['table_name']}: {str(e)}", type="error")
+            batch_synced = False
+    if batch_synced:
+        with Phase(target_table, 'diff', round_trips=1 if fingerprints else 0):
+            await save_fingerprints(fingerprints)
+    job.set_phase(target_table, 'extract')
+    return batch_synced, rows
+
+
+async def sync_rows(plan, errors, job, lease):
+    """
+        Stream the rows of a plan through the extract task, drop the unchanged ones and load the rest.
+
+        Returns:
+        bool: True when every batch is committed.
+    """
+
+    watermark_key = plan.primary['table_key']
+    await asyncio.to_thread(plan.resolve_projection)
+    where, params = await asyncio.to_thread(watermark_clause, watermark_key, plan.watermark_sql)
+    where, params = add_condition(where, params, plan.condition)
+
+    batches = asyncio.Queue(maxsize=SYNC_ASYNC_QUEUE_BATCHES)
+    reader = asyncio.create_task(extract(plan, plan.query + where, plan.query_params + params, batches))
+
+    fetched = False
+    synced = True
+    new_watermark = None
+    try:
+        while True:
+            records = await batches.get()
+            if records is DONE:
+                break
+            if isinstance(records, Exception):
+                raise records
+            fetched = True
+            job.add(rows_extracted=len(records))
+            batch_synced, rows = await sync_batch(plan, records, errors, job, lease)
+            if not rows:
+                continue
+            if not batch_synced:
+                synced = False
+            elif plan.watermark_column:
+                new_watermark = max_watermark(records, plan.watermark_column, new_watermark)
+    finally:
+        # the sync stopped early or failed, the reader stops and closes its connection
+        reader.cancel()
+        await asyncio.gather(reader, return_exceptions=True)
+
+    if not fetched:
+        logs(f"No data fetched from {plan.primary['table_name']}.", type="warning")
+
+    # move the watermark only when every batch is committed
+    if synced and new_watermark is not None:
+        await asyncio.to_thread(set_watermark, watermark_key, new_watermark)
+    return synced
+
+
+async def sync_plan_async(plan, errors, job):
+    """
+        Sync one plan on the event loop under a redis lease, the async twin of sync_engine.sync_plan.
+
+        Parameters:
+        - plan (SyncPlan): The compiled plan, native(plan) must be true.
+        - errors (list): The sync errors are appended to it.
+        - job (SyncJob): The job which tracks the progress.
+    """
+
+    target_table = plan.target_table
+    started = time.perf_counter()
+    try:
+        logs(f"{plan.name} syncing is starting")
+        if not claim_table(job, target_table):
+            errors.append(f"{target_table} is already syncing in another job")
+            return
+        job.set_phase(target_table, 'extract')
+
+        lease = await asyncio.to_thread(acquire, target_table)
+        if lease is None:
+            logs(f"{target_table} is syncing on another worker, it is skipped")
+            job.set_phase(target_table, 'skipped')
+            return
+        try:
+            synced = await sync_rows(plan, errors, job, lease)
+        finally:
+            await asyncio.to_thread(lease.release)
+
+        job.set_phase(target_table, 'done' if synced else 'failed')
+
+    except Exception as e:
+        logs(f"Error syncing {plan.name}: {str(e)}", type="error")
+        errors.append(f"Error syncing {plan.name}: {str(e)}")
+        job.set_phase(target_table, 'failed')
+    finally:
+        release_table(job, target_table)
+        await asyncio.to_thread(row_counts.flush, target_table)
+        observe_run(job, target_table, time.perf_counter() - started)
+
+
+def native(plan):
+    """Tell if a plan can run on the event loop: one source query, loaded with COPY, in one pass."""
+    return (
+        plan.load_strategy == 'copy'
+        and (not plan.supporting or plan.pushdown)
+        and plan.shards <= 1
+        and plan.readers <= 1
+        and not plan.checkpoint
+        and not plan.fanout
+    )
+
+
+@asynccontextmanager
+async def source_slots(db_names):
+    """Take the source database limits shared with the threaded runs, always in the same order."""
+    taken = []
+    try:
+        for semaphore in [source_semaphore(db_name) for db_name in sorted(set(db_names))]:
+            while not semaphore.acquire(blocking=False):
+                await asyncio.sleep(SOURCE_POLL_SECONDS)
+            taken.append(semaphore)
+        yield
+    finally:
+        for semaphore in reversed(taken):
+            semaphore.release()
+
+
+async def run_job(job, workers):
+    job_errors = []
+    async with workers, source_slots(job['sources']):
+        try:
+            await job['run'](job_errors)
+        except Exception as e:
+            logs(f"Error syncing {job['name']}: {str(e)}", type="error")
+            job_errors.append(f"Error syncing {job['name']}: {str(e)}")
+    return job_errors
+
+
+async def run_plans_async(group, job=None, name=None):
+    """
+        Sync every plan of a group concurrently on the event loop, the async twin of sync_engine.run_plans.
+
+        Parameters:
+        - group (str): The plan group (sync-tables, selective-column-sync-tables, combine-table-and-sync).
+        - job (SyncJob, optional): The job which tracks the progress.
+        - name (str, optional): Sync only the plan with this name instead of a group.
+
+        Returns:
+        bool: True if no errors were encountered.
+    """
+
+    job = job or SyncJob(name or group)
+    errors, plans, fanouts = await asyncio.to_thread(select_plans, group, name)
+
+    jobs = []
+    for plan in plans:
+        if native(plan):
+            run = partial(sync_plan_async, plan, job=job)
+        else:
+            run = partial(asyncio.to_thread, sync_plan, plan, job=job)
+        jobs.append({"name": plan.name, "sources": plan.db_names, "run": run})
+    for fanout, targets in fanouts.items():
+        run = partial(asyncio.to_thread, sync_fanout, targets, job=job)
+        jobs.append({"name": fanout, "sources": targets[0].db_names, "run": run})
+
+    workers = asyncio.Semaphore(SYNC_MAX_WORKERS)
+    results = await asyncio.gather(*[run_job(item, workers) for item in jobs])
+    errors += [error for job_errors in results for error in job_errors]
+    job.add_errors(errors)
+
+    if errors:
+        logs("Errors encountered during sync process:", type="error")
+        for error in errors:
+            logs(error, type="error")
+
+    return not errors
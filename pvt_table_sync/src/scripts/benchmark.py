@@ -0,0 +1,303 @@
+import argparse
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import Integer, String, DateTime, Float, MetaData
+from sqlalchemy.orm import declarative_base
+from prometheus_client import REGISTRY
+import models
+from config import engine, SYNC_BATCH_SIZE, SYNC_PLANS_FILE
+from scripts.jobs import SyncJob
+from scripts.leases import Lease
+from scripts.sync_engine import SyncPlan, read_batches, sync_batch
+from scripts.sync_state import reset_fingerprints
+
+
+"""
+    this code benchmarks the sync paths on synthetic data, without the legacy mysql
+    * the source tables are generated in batches in the shapes of the sync plans
+      (tower_config, tariff_config), the supporting table of tariff_config
+      is generated too and joined through the hash join
+    * the rows go through the functions of the sync engine (read_batches, sync_batch), the
+      generated tables stand in for the mysql reads, so the numbers are the ones of a real sync
+    * the target is a bench_ copy of the model table in the configured postgres,
+      point PRODUCTION_POSTGRES_* at a local database (docker compose --profile bench up)
+    * the target is seeded first, then the source is synced with a share of changed rows,
+      new rows and repeated keys
+    * every case runs in its own process so its peak memory is its own
+    the result is json: rows/sec, peak RSS and the seconds of every phase as the engine measures
+    them (extract, merge, dedupe, diff, target_lookup, load, commit), --baseline compares it with an earlier result
+    e.g. python -m scripts.benchmark --rows 10000,100000 --output bench.json
+"""
+
+BenchBase = declarative_base(metadata=MetaData())
+
+BASE_TIME = datetime(2024, 1, 1)
+# the phases measured by the sync engine, see scripts/metrics.py
+ENGINE_PHASES = ('extract', 'merge', 'dedupe', 'diff', 'target_lookup', 'load', 'commit')
+PHASES = ('seed',) + ENGINE_PHASES
+
+
+def bench_model(name):
+    """A model class on a bench_ copy of a table, so the real tables are never written."""
+    model = getattr(models, name)
+    table = model.__table__.to_metadata(BenchBase.metadata, name=f"bench_{model.__tablename__}")
+    return type(f"Bench{name}", (BenchBase,), {'__table__': table, '__tablename__': table.name})
+
+
+def bench_plan(name):
+    """The plan definition from sync_plans.json on the bench model, with every source on one stream."""
+    with open(SYNC_PLANS_FILE) as plan_file:
+        definition = next(plan for plan in json.load(plan_file)['plans'] if plan['name'] == name)
+    definition = dict(definition, model=bench_model(definition['model']))
+    # mysql is not used, the supporting tables are joined client side and read again on every run
+    definition['sources'] = [
+        dict(source, server=f"bench_{count}", snapshot=None) for count, source in enumerate(definition['sources'])
+    ]
+    return SyncPlan(definition)
+
+
+def value(column_type, column, number, version):
+    """A synthetic value of a column, version changes every non key value."""
+    if isinstance(column_type, Integer):
+        return number * 7 + version
+    if isinstance(column_type, Float):
+        return round((number % 1000) * 0.25 + version, 2)
+    if isinstance(column_type, DateTime):
+        return BASE_TIME + timedelta(seconds=number, minutes=version)
+    length = getattr(column_type, 'length', None) or 250
+    return f"{column[:4]}{number}v{version}"[-length:]
+
+
+def key_value(column_type, number):
+    return number if isinstance(column_type, Integer) else f"k{number}"
+
+
+class Generator:
+    """Synthetic batches of a source table of a plan."""
+
+    def __init__(self, plan, source, rows, change_ratio, insert_ratio, duplicate_ratio, seed=7):
+        self.plan = plan
+        self.rows = rows
+        self.existing = int(rows * (1 - insert_ratio))
+        self.change_ratio = change_ratio
+        self.duplicate_ratio = duplicate_ratio
+        self.seed = seed
+
+        types = plan.model.__table__.columns
+        mapping = plan.column_mapping or {column.name: column.name for column in types}
+        key_type = types[mapping[plan.key_column]].type
+        self.columns = []
+        for column in source.get('select_columns') or list(mapping):
+            if column in (plan.key_column, source.get('merging_on')):
+                # the join columns get the values of the key, so every row finds its match
+                self.columns.append((column, key_type, True))
+            else:
+                target = mapping.get(column)
+                self.columns.append((column, types[target].type if target else String(50), False))
+
+    def record(self, number, version):
+        return {
+            column: key_value(column_type, number) if is_key else value(column_type, column, number, version)
+            for column, column_type, is_key in self.columns
+        }
+
+    def seed_batches(self, batch_size=SYNC_BATCH_SIZE):
+        """The rows which are already in the target."""
+        for start in range(0, self.existing, batch_size):
+            yield [self.record(number, 0) for number in range(start, min(start + batch_size, self.existing))]
+
+    def batches(self, batch_size=SYNC_BATCH_SIZE):
+        """The source rows: changed, unchanged, new and repeated ones."""
+        rng = random.Random(self.seed)
+        batch = []
+        for number in range(self.rows):
+            version = 1 if number < self.existing and rng.random() < self.change_ratio else 0
+            batch.append(self.record(number, version))
+            if rng.random() < self.duplicate_ratio:
+                batch.append(self.record(number, version))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def phase_totals(table):
+    """The seconds of every phase of a table so far, from the metrics of the sync engine."""
+    return {
+        phase: REGISTRY.get_sample_value('table_sync_phase_seconds_sum', {'table': table, 'phase': phase}) or 0.0
+        for phase in ENGINE_PHASES
+    }
+
+
+def source_reader(generators, batch_size, seed=False):
+    """A stand in of stream_db_data which reads the synthetic table of a bench server."""
+    def read(query, data_value=(), server='legacy', **kwargs):
+        generator = generators[server]
+        return generator.seed_batches(batch_size) if seed else generator.batches(batch_size)
+    return read
+
+
+def sync(plan, read, job):
+    """
+        Sync the synthetic source through the engine: read_batches and sync_batch, as sync_rows does.
+
+        Returns:
+        tuple: (extracted, unique) row counts.
+    """
+
+    errors = []
+    extracted = unique = 0
+    lease = Lease(plan.target_table)
+    for records in read_batches(plan, read(plan.query, server=plan.server), read):
+        extracted += len(records)
+        _, rows = sync_batch(plan, records, errors, job, lease)
+        unique += len(rows)
+    if errors:
+        raise RuntimeError(errors[0])
+    return extracted, unique
+
+
+def run_case(case):
+    """
+        Seed a bench table and sync synthetic source rows into it.
+
+        Parameters:
+        - case (dict): plan, rows, strategy, fingerprint, change_ratio, insert_ratio, duplicate_ratio, batch_size.
+
+        Returns:
+        dict: The case with its timings, row counts, rows per second and peak RSS.
+    """
+
+    plan = bench_plan(case['plan'])
+    plan.load_strategy = case['strategy']
+    plan.fingerprint_cache = case['fingerprint']
+    table = plan.model.__table__
+    table.drop(engine, checkfirst=True)
+    table.create(engine)
+    reset_fingerprints(plan.target_table)
+
+    ratios = {key: case[key] for key in ('change_ratio', 'insert_ratio', 'duplicate_ratio')}
+    generators = {
+        source['server']: Generator(plan, source, case['rows'], **ratios) for source in plan.sources
+    }
+    batch_size = case['batch_size']
+
+    try:
+        # seed the target (and the fingerprints of the previous sync) with the rows which exist before the sync
+        start = time.perf_counter()
+        sync(plan, source_reader(generators, batch_size, seed=True), SyncJob(f"bench-seed-{plan.name}"))
+        seed_seconds = time.perf_counter() - start
+
+        # the sync run
+        before = phase_totals(plan.target_table)
+        job = SyncJob(f"bench-{plan.name}")
+        started = time.perf_counter()
+        extracted, unique = sync(plan, source_reader(generators, batch_size), job)
+        seconds = time.perf_counter() - started
+        after = phase_totals(plan.target_table)
+    finally:
+        table.drop(engine, checkfirst=True)
+        reset_fingerprints(plan.target_table)
+
+    phases = {'seed': seed_seconds, **{phase: after[phase] - before[phase] for phase in ENGINE_PHASES}}
+    return dict(
+        case,
+        seconds=round(seconds, 3),
+        rows_per_second=round(extracted / seconds, 1) if seconds else 0.0,
+        peak_rss_mb=peak_rss_mb(),
+        phases={phase: round(phases[phase], 3) for phase in PHASES},
+        counts={'extracted': extracted, 'unique': unique, 'written': job.rows_written}
+    )
+
+
+def compare(results, baseline, tolerance):
+    """Return the cases which are slower than in the baseline by more than tolerance (0.2 = 20%)."""
+    case_id = lambda result: (result['plan'], result['rows'], result['strategy'], result['fingerprint'])
+    before = {case_id(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        old = before.get(case_id(result))
+        if old and result['rows_per_second'] < old['rows_per_second'] * (1 - tolerance):
+            regressions.append({
+                'plan': result['plan'], 'rows': result['rows'], 'strategy': result['strategy'],
+                'rows_per_second': result['rows_per_second'], 'baseline_rows_per_second': old['rows_per_second']
+            })
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the sync paths on synthetic data.")
+    parser.add_argument('--plans', default='tower_config,tariff_config')
+    parser.add_argument('--rows', default='10000,100000,1000000', help="e.g. 10000,100000,1000000,10000000")
+    parser.add_argument('--strategies', default='copy', help="copy,orm")
+    parser.add_argument('--no-fingerprint', action='store_true', help="skip the redis fingerprint diff")
+    parser.add_argument('--change-ratio', type=float, default=0.1)
+    parser.add_argument('--insert-ratio', type=float, default=0.05)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.01)
+    parser.add_argument('--batch-size', type=int, default=SYNC_BATCH_SIZE)
+    parser.add_argument('--output', help="write the json result to this file instead of stdout")
+    parser.add_argument('--baseline', help="an earlier json result, exit 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case)), default=str))
+        return 0
+
+    results = []
+    for plan in args.plans.split(','):
+        for rows in [int(rows) for rows in args.rows.split(',')]:
+            for strategy in args.strategies.split(','):
+                case = {
+                    'plan': plan, 'rows': rows, 'strategy': strategy, 'fingerprint': not args.no_fingerprint,
+                    'change_ratio': args.change_ratio, 'insert_ratio': args.insert_ratio,
+                    'duplicate_ratio': args.duplicate_ratio, 'batch_size': args.batch_size
+                }
+                # a process per case, so the peak RSS of a case is not the peak of an earlier one
+                run = subprocess.run(
+                    [sys.executable, '-m', 'scripts.benchmark', '--case', json.dumps(case)],
+                    capture_output=True, text=True
+                )
+                if run.returncode:
+                    results.append(dict(case, error=run.stderr.strip().splitlines()[-1:]))
+                else:
+                    results.append(json.loads(run.stdout.strip().splitlines()[-1]))
+                print(f"{plan} {rows} rows {strategy}: {results[-1].get('rows_per_second', 'failed')} rows/sec",
+                      file=sys.stderr)
+
+    report = {
+        'created_at': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'results': results
+    }
+    exit_code = 1 if any('error' in result for result in results) else 0
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            report['regressions'] = compare(results, json.load(baseline_file), args.tolerance)
+        exit_code = exit_code or (1 if report['regressions'] else 0)
+
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
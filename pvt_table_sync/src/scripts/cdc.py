@@ -0,0 +1,336 @@
+import json
+import os
+import sys
+import time
+from config import mysql_engines, stream_db_data
+from utils import logs, row_counts
+from scripts.jobs import SyncJob
+from scripts.leases import acquire
+from scripts.loader import delete_rows
+from scripts.predicates import add_condition
+from scripts.sync_engine import load_plans, build_joins, in_clause, load_batch
+from scripts.sync_state import (
+    filter_changed, save_fingerprints, forget_fingerprints, get_cdc_position, set_cdc_position
+)
+
+
+"""
+    this code keeps the plans with "cdc": true in sync from the mysql row based binlog
+    * the binlog of a server is tailed from the saved position for the source tables of the plans
+    * every row event becomes an upsert or a delete of a key, the events are collected into
+      micro-batches in which the last event of a key wins
+    * a single table plan is written from the event values, for a plan with supporting tables
+      the affected keys are read again through the plan query so the joined columns are current
+    * the binlog position is saved after a transaction is written to postgres, a restart
+      continues from the last committed transaction
+    * a micro-batch is written under the lease of its target table with its fencing token,
+      like a full sync, so it waits while a full sync of the table is running
+    * recorded events (json lines, see fixtures/) can be replayed instead of a live server,
+      a replay doesn't save its positions
+    the full syncs still run next to it, both only write rows which changed
+"""
+
+# number of row events applied in one micro-batch
+SYNC_CDC_BATCH_SIZE = int(os.environ.get('SYNC_CDC_BATCH_SIZE', 1000))
+# seconds a row event waits before its micro-batch is written
+SYNC_CDC_FLUSH_SECONDS = float(os.environ.get('SYNC_CDC_FLUSH_SECONDS', 1.0))
+# seconds between two reads of the binlog when there is nothing new
+SYNC_CDC_POLL_SECONDS = float(os.environ.get('SYNC_CDC_POLL_SECONDS', 1.0))
+# the replica id the reader uses on the mysql server, it must be unique among the replicas
+SYNC_CDC_SERVER_ID = int(os.environ.get('SYNC_CDC_SERVER_ID', 4201))
+
+
+def cdc_plans(server):
+    """Return the cdc plans of a server by source table (db.table) as [(plan, source), ...]."""
+    plans, _ = load_plans()
+    tables = {}
+    for plan in plans:
+        if not plan.cdc or plan.server != server:
+            continue
+        for source in plan.sources:
+            tables.setdefault(source['table_key'], []).append((plan, source))
+    return tables
+
+
+def binlog_events(server, tables, position=None):
+    """
+        Tail the binlog of a mysql server, the events are yielded as dictionaries.
+
+        Parameters:
+        - server (str): The mysql server name in config.mysql_engines.
+        - tables (list): The source tables (db.table) to read the events of.
+        - position (dict, optional): {'log_file', 'log_pos'} to start from, the current end of the binlog if None.
+
+        Returns:
+        generator: {'type': 'insert' | 'update' | 'delete', 'schema', 'table', 'values', 'before'} row events,
+        {'type': 'commit', 'log_file', 'log_pos'} at every transaction end and {'type': 'idle'}
+        when the binlog has nothing new.
+    """
+
+    # only needed for the live mode, replaying fixtures works without it
+    from pymysqlreplication import BinLogStreamReader
+    from pymysqlreplication.event import XidEvent
+    from pymysqlreplication.row_event import WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent
+
+    url = mysql_engines[server].url
+    settings = {'host': url.host, 'port': url.port or 3306, 'user': url.username, 'passwd': url.password}
+    schemas = sorted({table.split('.', 1)[0] for table in tables})
+    table_names = sorted({table.split('.', 1)[1] for table in tables})
+
+    while True:
+        reader = BinLogStreamReader(
+            connection_settings=settings,
+            server_id=SYNC_CDC_SERVER_ID,
+            only_events=[WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent, XidEvent],
+            only_schemas=schemas,
+            only_tables=table_names,
+            resume_stream=position is not None,
+            log_file=position['log_file'] if position else None,
+            log_pos=position['log_pos'] if position else None,
+            blocking=False
+        )
+        try:
+            for event in reader:
+                if isinstance(event, XidEvent):
+                    position = {'log_file': reader.log_file, 'log_pos': reader.log_pos}
+                    yield {'type': 'commit', **position}
+                    continue
+
+                if f"{event.schema}.{event.table}" not in tables:
+                    continue
+                for row in event.rows:
+                    if isinstance(event, UpdateRowsEvent):
+                        yield {
+                            'type': 'update', 'schema': event.schema, 'table': event.table,
+                            'values': row['after_values'], 'before': row['before_values']
+                        }
+                    else:
+                        yield {
+                            'type': 'insert' if isinstance(event, WriteRowsEvent) else 'delete',
+                            'schema': event.schema, 'table': event.table, 'values': row['values']
+                        }
+
+            if position is None:
+                # nothing happened yet, start from the current end of the binlog next time
+                position = {'log_file': reader.log_file, 'log_pos': reader.log_pos}
+        finally:
+            reader.close()
+
+        yield {'type': 'idle'}
+        time.sleep(SYNC_CDC_POLL_SECONDS)
+
+
+def fixture_events(path):
+    """Replay recorded binlog events from a json lines file, in the format binlog_events yields."""
+    with open(path) as fixture_file:
+        for line in fixture_file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def table_lease(target_table):
+    """Take the lease of a target table, waiting while another worker syncs it."""
+    lease = acquire(target_table)
+    if lease is None:
+        logs(f"{target_table} is syncing on another worker, cdc waits for its lease")
+    while lease is None:
+        time.sleep(SYNC_CDC_POLL_SECONDS)
+        lease = acquire(target_table)
+    return lease
+
+
+class ChangeBatch:
+    """The pending changes of one plan, the last event of a key wins."""
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.upserts = {}
+        self.deletes = set()
+        self.refresh = set()
+
+    def add(self, event, source):
+        plan = self.plan
+        values = event['values']
+        if plan.getter is None:
+            # select * without a column_mapping, the event has every column of the table
+            plan.bind_record(values)
+
+        if plan.supporting:
+            if source is plan.primary and event['type'] == 'delete':
+                key = values.get(plan.key_column)
+                self.deletes.add(key)
+                self.refresh.discard(values.get(plan.primary['merging_on']))
+                return
+            # the joined row is read again, so it has the current values of every source
+            for row_values in (values, event.get('before') or {}):
+                value = row_values.get(source['merging_on'])
+                if value is not None:
+                    self.refresh.add(value)
+            return
+
+        if plan.filter and event['type'] != 'delete' and not plan.filter(values):
+            # like a full sync, a row which doesn't pass the filter is not written
+            return
+        row = plan.getter(values)
+        key = row[plan.key_index]
+        if key is None:
+            return
+        if event['type'] == 'delete':
+            self.upserts.pop(key, None)
+            self.deletes.add(key)
+        else:
+            self.deletes.discard(key)
+            self.upserts[key] = row
+        before_key = (event.get('before') or {}).get(plan.key_column)
+        if before_key is not None and before_key != key:
+            # the key itself was updated, the row under the old key is gone
+            self.upserts.pop(before_key, None)
+            self.deletes.add(before_key)
+
+    def __len__(self):
+        return len(self.upserts) + len(self.deletes) + len(self.refresh)
+
+    def refreshed_rows(self):
+        """Read the affected rows again through the plan query."""
+        plan = self.plan
+        values = sorted(self.refresh, key=str)
+        column = f"p.{plan.primary['merging_on']}" if plan.pushdown else plan.primary['merging_on']
+        where, params = add_condition(*in_clause(column, values), plan.condition)
+        batches = stream_db_data(plan.query + where, data_value=plan.query_params + params, server=plan.server)
+        if not plan.pushdown:
+            for join in build_joins(plan, values):
+                batches = join.stream(batches)
+
+        rows = []
+        for records in batches:
+            rows += plan.to_rows(records)
+        return rows
+
+    def apply(self, errors, job):
+        """
+            Write the pending changes to the target under the lease of the target table.
+
+            Returns:
+            bool: True when every change is committed.
+        """
+
+        lease = table_lease(self.plan.target_table)
+        try:
+            return self.write(errors, job, lease)
+        finally:
+            lease.release()
+
+    def write(self, errors, job, lease):
+        plan = self.plan
+        if self.deletes:
+            deletes = [key for key in self.deletes if key is not None]
+            try:
+                deleted = delete_rows(plan.target_table, plan.target_key, deletes, lease)
+                forget_fingerprints(plan.target_table, plan.target_columns, deletes)
+                job.add(rows_written=deleted)
+                logs(f"cdc deleted {deleted} rows from {plan.target_table}")
+            except Exception as e:
+                errors.append(f"Error deleting rows from {plan.target_table}: {str(e)}")
+                logs(f"Error deleting rows from {plan.target_table}: {str(e)}", type="error")
+                return False
+
+        rows = list(self.upserts.values())
+        if self.refresh:
+            rows += self.refreshed_rows()
+        if not rows:
+            return True
+
+        job.add(rows_extracted=len(rows))
+        changed_rows, fingerprints = rows, None
+        if plan.fingerprint_cache:
+            changed_rows, fingerprints = filter_changed(plan.target_table, rows, plan.key_index, plan.target_columns)
+        job.add(rows_diffed=len(rows))
+
+        synced = not changed_rows or load_batch(plan, changed_rows, errors, job, lease)
+        row_counts.flush(plan.target_table)
+        if synced:
+            save_fingerprints(fingerprints)
+        return synced
+
+
+def flush(batches, errors, job):
+    ok = True
+    for batch in batches.values():
+        if batch:
+            ok = batch.apply(errors, job) and ok
+    batches.clear()
+    return ok
+
+
+def run_cdc(server='legacy', fixture=None, job=None):
+    """
+        Apply the binlog changes of the cdc plans of a server to postgres.
+
+        Parameters:
+        - server (str, optional): The mysql server name, the legacy server by default.
+        - fixture (str, optional): A json lines file of recorded events to replay instead of the live binlog,
+          the run ends at the end of the file, the saved binlog position of the server is not changed.
+        - job (SyncJob, optional): The job which tracks the progress.
+
+        Returns:
+        bool: True if no errors were encountered, a live run only returns on an error.
+    """
+
+    job = job or SyncJob(f"cdc-{server}")
+    tables = cdc_plans(server)
+    if not tables:
+        logs(f"No cdc plans for the {server} server.", type="warning")
+        return True
+
+    if fixture:
+        events = fixture_events(fixture)
+    else:
+        position = get_cdc_position(server)
+        logs(f"cdc of {server} is starting from {position or 'the end of the binlog'} for {sorted(tables)}")
+        events = binlog_events(server, list(tables), position)
+
+    errors = []
+    batches = {}
+    pending = 0
+    first_pending = None
+    commit = None
+    for event in events:
+        if event['type'] in ('insert', 'update', 'delete'):
+            for plan, source in tables.get(f"{event['schema']}.{event['table']}", []):
+                batches.setdefault(plan.name, ChangeBatch(plan)).add(event, source)
+            pending += 1
+            first_pending = first_pending or time.monotonic()
+            continue
+
+        if event['type'] == 'commit':
+            commit = event
+        # the batch is written on a transaction end, so the saved position is never inside a transaction
+        if commit and (
+            pending >= SYNC_CDC_BATCH_SIZE
+            or (first_pending and time.monotonic() - first_pending >= SYNC_CDC_FLUSH_SECONDS)
+            or (event['type'] == 'idle')
+        ):
+            if not flush(batches, errors, job):
+                break
+            # a replayed fixture never moves the saved position of the live binlog
+            if not fixture:
+                set_cdc_position(server, commit['log_file'], commit['log_pos'])
+            pending, first_pending, commit = 0, None, None
+
+    else:
+        # the fixture ended, write what is left
+        if commit:
+            flush(batches, errors, job)
+
+    job.add_errors(errors)
+    for error in errors:
+        logs(error, type="error")
+    return not errors
+
+
+# Example usage: python -m scripts.cdc legacy [fixtures/binlog_tariff_config.jsonl]
+if __name__ == "__main__":
+    run_cdc(
+        sys.argv[1] if len(sys.argv) > 1 else 'legacy',
+        fixture=sys.argv[2] if len(sys.argv) > 2 else None
+    )
@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+
+
+"""
+    this code compares a batch of source rows with the matching target rows column by column
+    * both sides are loaded into data frames and the target rows are aligned to the source
+      rows on the key, a key repeated in the target keeps its last row
+    * every compared column gives a changed mask in one vectorized comparison, a null on both
+      sides is equal, the masks of all the columns are or-ed into the changed rows
+    * values are compared like python does (1 == 1.0, '1' != 1), so the result is the same
+      as comparing the rows one by one
+"""
+
+
+def diff_rows(rows, target_rows, columns, key_column, target_columns=None):
+    """
+        Split a batch of source rows into the keys to insert, to update and the unchanged keys.
+
+        Parameters:
+        - rows (list): Source row tuples in the order of columns, one row per key.
+        - target_rows (list): The target row tuples with the keys of the batch.
+        - columns (list): The column names of the source rows, they are all compared.
+        - key_column (str): The column which matches the rows.
+        - target_columns (list, optional): The column names of the target rows when they
+          have more columns than the source rows (e.g. the primary key).
+
+        Returns:
+        tuple: (insert keys, update keys, unchanged keys) as lists.
+    """
+
+    source = pd.DataFrame.from_records(rows, columns=columns)
+    if not target_rows:
+        return source[key_column].tolist(), [], []
+
+    target = pd.DataFrame.from_records(target_rows, columns=target_columns or columns)
+    target = target.drop_duplicates(subset=key_column, keep='last').set_index(key_column)
+
+    found = source[key_column].isin(target.index).to_numpy()
+    inserts = source[key_column][~found]
+    matched = source[found].reset_index(drop=True)
+    current = target.reindex(matched[key_column]).reset_index(drop=True)
+
+    changed = np.zeros(len(matched), dtype=bool)
+    for column in columns:
+        if column == key_column:
+            continue
+        new, old = matched[column], current[column]
+        changed |= (new.ne(old) & ~(new.isna() & old.isna())).to_numpy()
+
+    keys = matched[key_column]
+    return inserts.tolist(), keys[changed].tolist(), keys[~changed].tolist()
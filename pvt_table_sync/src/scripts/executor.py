@@ -0,0 +1,61 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import SYNC_MAX_WORKERS, SYNC_DB_CONCURRENCY
+from utils import logs
+
+
+"""
+    this code runs independent table syncs at the same time on a thread pool
+    * every job is a dict with a name, the source databases it reads and a run(errors) callable
+    * a source database is read by at most SYNC_DB_CONCURRENCY jobs at a time,
+      the limit is shared by every run_jobs call in the process
+"""
+
+source_limits = {}
+source_limits_lock = threading.Lock()
+
+
+def source_semaphore(db_name):
+    db_name = db_name.rstrip('.')
+    with source_limits_lock:
+        if db_name not in source_limits:
+            source_limits[db_name] = threading.BoundedSemaphore(SYNC_DB_CONCURRENCY)
+        return source_limits[db_name]
+
+
+def run_job(job):
+    job_errors = []
+    # always take the locks in the same order so two jobs never wait on each other
+    semaphores = [source_semaphore(db_name) for db_name in sorted(set(job['sources']))]
+    for semaphore in semaphores:
+        semaphore.acquire()
+    try:
+        job['run'](job_errors)
+    except Exception as e:
+        logs(f"Error syncing {job['name']}: {str(e)}", type="error")
+        job_errors.append(f"Error syncing {job['name']}: {str(e)}")
+    finally:
+        for semaphore in reversed(semaphores):
+            semaphore.release()
+    return job_errors
+
+
+def run_jobs(jobs, max_workers=SYNC_MAX_WORKERS):
+    """
+        Run the sync jobs in parallel and wait for all of them.
+
+        Parameters:
+        - jobs (list): Dicts with name, sources (list of db names) and run (callable taking an errors list).
+        - max_workers (int, optional): The number of jobs running at the same time.
+
+        Returns:
+        list: The errors of every job.
+    """
+
+    if not jobs:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs)), thread_name_prefix='table_sync') as pool:
+        results = list(pool.map(run_job, jobs))
+
+    return [error for job_errors in results for error in job_errors]
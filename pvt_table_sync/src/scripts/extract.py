@@ -0,0 +1,143 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import stream_db_data
+from scripts.executor import source_semaphore
+from utils import logs
+
+
+"""
+    this code reads one big source table over several connections at the same time
+    * the integer key bounds of the rows to read are found first, the key space is split into
+      ranges which readers take one by one, so a slow range doesn't hold back the others
+    * every reader streams its range with its own pooled connection and puts the batches
+      on a bounded queue, the sync reads them from the queue in the order they come,
+      a full queue makes the readers wait, so memory stays bounded
+    * a table without an integer key is read by one connection
+    * the job's own SYNC_DB_CONCURRENCY slot covers the first reader, every extra reader takes
+      a free slot of the source database and gives it back when the read ends, so the
+      connections of one database stay within SYNC_DB_CONCURRENCY; without free slots the
+      table is read by fewer readers instead of waiting
+"""
+
+# number of connections reading one table, a plan can set its own "readers"
+SYNC_EXTRACT_READERS = int(os.environ.get('SYNC_EXTRACT_READERS', 1))
+# key ranges per reader, more ranges balance skewed keys better
+RANGES_PER_READER = 4
+# batches waiting for the sync per reader
+QUEUE_BATCHES_PER_READER = 2
+
+DONE = object()
+
+
+def key_ranges(plan, key_sql, where, params, count):
+    """
+        Split the integer keys of the rows to read into ranges.
+
+        Returns:
+        list | None: [(lo, hi), ...] with lo <= key < hi, None when the key is not an integer.
+    """
+
+    bounds = []
+    for rows in stream_db_data(
+        f"SELECT MIN({key_sql}), MAX({key_sql}) FROM {plan.primary['table_key']} p{where}",
+        data_value=params, is_dict=False, server=plan.server
+    ):
+        bounds += rows
+    lo, hi = bounds[0] if bounds else (None, None)
+    if not isinstance(lo, int) or not isinstance(hi, int):
+        return None
+
+    width = max(1, -(-(hi + 1 - lo) // count))
+    return [(start, min(start + width, hi + 1)) for start in range(lo, hi + 1, width)]
+
+
+def offer(batches, item, stop):
+    """Put an item on the queue, waiting while it is full, False when the sync stopped reading."""
+    while not stop.is_set():
+        try:
+            batches.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def read_range(plan, query, params, batches, stop):
+    for records in stream_db_data(query, data_value=params, server=plan.server):
+        if not offer(batches, records, stop):
+            return
+    offer(batches, DONE, stop)
+
+
+def release_slots(pool, semaphore, slots):
+    """Give the reader slots back once the running reads have closed their connections."""
+    def release():
+        pool.shutdown(wait=True)
+        for _ in range(slots):
+            semaphore.release()
+
+    if slots:
+        threading.Thread(target=release, name='extract-release', daemon=True).start()
+
+
+def parallel_stream(plan, key_sql, where, params, readers, ranges, ordered=False):
+    """
+        Read the rows of a plan query over several connections.
+
+        Parameters:
+        - plan (SyncPlan): The compiled plan.
+        - key_sql (str): The key column in the query (p.id with a join).
+        - where (str): The WHERE clause of the rows to read, '' for all of them.
+        - params (tuple): The parameters of where.
+        - readers (int): The most connections, fewer when the source database has no free slots.
+        - ranges (list): The [lo, hi) key ranges from key_ranges.
+        - ordered (bool, optional): Read every range in key order.
+
+        Returns:
+        generator: Batches of dictionaries, the batches of a range come in order,
+        the ranges are mixed.
+    """
+
+    semaphore = source_semaphore(plan.primary['db_name'])
+    slots = 0
+    while slots < readers - 1 and semaphore.acquire(blocking=False):
+        slots += 1
+    readers = slots + 1
+
+    logs(f"{plan.primary['table_name']} is read by {readers} readers in {len(ranges)} key ranges")
+    batches = queue.Queue(maxsize=readers * QUEUE_BATCHES_PER_READER)
+    stop = threading.Event()
+    condition = f"{key_sql} >= %s AND {key_sql} < %s"
+    query = plan.query + (f"{where} AND {condition}" if where else f" WHERE {condition}")
+    if ordered:
+        query += f" ORDER BY {key_sql}"
+
+    def read(lo, hi):
+        try:
+            read_range(plan, query, plan.query_params + tuple(params) + (lo, hi), batches, stop)
+        except Exception as e:
+            offer(batches, e, stop)
+
+    pool = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='extract')
+    try:
+        for lo, hi in ranges:
+            pool.submit(read, lo, hi)
+
+        pending = len(ranges)
+        while pending:
+            records = batches.get()
+            if records is DONE:
+                pending -= 1
+            elif isinstance(records, Exception):
+                raise records
+            else:
+                yield records
+    finally:
+        # the sync stopped early or failed, the readers stop at their next batch
+        stop.set()
+        while not batches.empty():
+            batches.get_nowait()
+        pool.shutdown(wait=False, cancel_futures=True)
+        release_slots(pool, semaphore, slots)
@@ -0,0 +1,139 @@
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+from utils import logs
+
+
+"""
+    this code left joins a streamed table to a supporting table without holding both in memory
+    * the supporting (build) side is kept as a dict of key: tuple of its columns, a repeated key keeps the last row
+    * the first (probe) table is streamed through it batch by batch, the joined columns are added to each row
+    * when the build side grows past the memory budget it is split into partitions on local disk,
+      the probe rows are then partitioned the same way and every partition is joined on its own
+"""
+
+# memory allowed for the build side of a join before it is spilled to disk
+SYNC_JOIN_MEMORY_MB = int(os.environ.get('SYNC_JOIN_MEMORY_MB', 256))
+SYNC_JOIN_PARTITIONS = int(os.environ.get('SYNC_JOIN_PARTITIONS', 16))
+# rows measured to estimate the size of a build row
+SIZE_SAMPLE_ROWS = 1000
+
+
+def row_size(key, values):
+    return sys.getsizeof(key) + sys.getsizeof(values) + sum(sys.getsizeof(value) for value in values)
+
+
+class HashJoin:
+    """Left join of streamed batches of dictionaries to a build side read once."""
+
+    def __init__(self, probe_key, build_key, columns, memory_budget=SYNC_JOIN_MEMORY_MB * 1024 * 1024,
+                 partitions=SYNC_JOIN_PARTITIONS):
+        self.probe_key = probe_key
+        self.build_key = build_key
+        self.columns = tuple(columns)
+        self.empty = (None,) * len(self.columns)
+        self.memory_budget = memory_budget
+        self.partitions = partitions
+        self.table = {}
+        self.row_bytes = None
+        self.spill_dir = None
+
+    def build(self, batches):
+        """Load the build side from batches of dictionaries."""
+        sampled = 0
+        sample_bytes = 0
+        for records in batches:
+            rows = [
+                (record[self.build_key], tuple([record.get(column) for column in self.columns]))
+                for record in records if record.get(self.build_key) is not None
+            ]
+
+            if self.spill_dir:
+                self.spill(rows, 'build')
+                continue
+
+            for key, values in rows:
+                self.table[key] = values
+                if sampled < SIZE_SAMPLE_ROWS:
+                    sampled += 1
+                    sample_bytes += row_size(key, values)
+
+            if sampled:
+                self.row_bytes = sample_bytes / sampled
+                if len(self.table) * self.row_bytes > self.memory_budget:
+                    self.start_spill()
+        return self
+
+    def start_spill(self):
+        self.spill_dir = tempfile.mkdtemp(prefix='table_sync_join_')
+        logs(
+            f"join build side on {self.build_key} is over {self.memory_budget // (1024 * 1024)} MB, "
+            f"spilling {self.partitions} partitions to {self.spill_dir}",
+            type="warning"
+        )
+        self.spill(list(self.table.items()), 'build')
+        self.table = {}
+
+    def partition_file(self, side, partition):
+        return os.path.join(self.spill_dir, f'{side}_{partition}.pkl')
+
+    def spill(self, rows, side, key=None):
+        """Append rows to the partition files of a side, key picks the join key of a row."""
+        key = key or (lambda row: row[0])
+        parts = {}
+        for row in rows:
+            parts.setdefault(hash(key(row)) % self.partitions, []).append(row)
+        for partition, part_rows in parts.items():
+            with open(self.partition_file(side, partition), 'ab') as part_file:
+                pickle.dump(part_rows, part_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def read_partition(self, side, partition):
+        path = self.partition_file(side, partition)
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as part_file:
+            while True:
+                try:
+                    yield pickle.load(part_file)
+                except EOFError:
+                    return
+
+    def probe(self, records, table=None):
+        """Add the joined columns to every record of a batch, in place."""
+        table = self.table if table is None else table
+        columns = self.columns
+        empty = self.empty
+        probe_key = self.probe_key
+        for record in records:
+            record.update(zip(columns, table.get(record.get(probe_key), empty)))
+        return records
+
+    def stream(self, batches):
+        """Join a stream of probe batches, the joined batches are yielded as they are ready."""
+        try:
+            for records in batches:
+                if not self.spill_dir:
+                    yield self.probe(records)
+                else:
+                    self.spill(records, 'probe', key=lambda record: record.get(self.probe_key))
+
+            if not self.spill_dir:
+                return
+
+            # join the partitions one by one, only one build partition is in memory at a time
+            for partition in range(self.partitions):
+                table = {}
+                for rows in self.read_partition('build', partition):
+                    table.update(rows)
+                for records in self.read_partition('probe', partition):
+                    yield self.probe(records, table)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+        self.table = {}
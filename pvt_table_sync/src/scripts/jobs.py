@@ -0,0 +1,249 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from uuid import uuid4
+from utils import logs
+
+
+"""
+    this code runs the syncs as background jobs so the api returns at once
+    * every job gets an id, its status and progress counters are kept in memory
+    * a job can't start while another job with the same name or a shared table is running
+    * a table is claimed by the job while it syncs, so two jobs never write the same table
+    * a job whose tables were all synced by another worker at the same time ends as skipped
+    * a coroutine sync (scripts/async_engine.py) runs as a task on the event loop of the api
+      instead of a job thread, it is registered and tracked the same way
+"""
+
+# number of sync jobs which run at the same time in the process
+SYNC_JOB_WORKERS = int(os.environ.get('SYNC_JOB_WORKERS', 2))
+# number of finished jobs kept for the status endpoint
+SYNC_JOB_HISTORY = int(os.environ.get('SYNC_JOB_HISTORY', 100))
+
+jobs = {}
+active_names = {}
+active_tables = {}
+registry_lock = threading.Lock()
+job_pool = ThreadPoolExecutor(max_workers=SYNC_JOB_WORKERS, thread_name_prefix='sync_job')
+# the running coroutine jobs, the event loop keeps only weak references to its tasks
+job_tasks = set()
+
+
+class JobConflict(Exception):
+    def __init__(self, job_id, detail):
+        super().__init__(detail)
+        self.job_id = job_id
+        self.detail = detail
+
+
+class SyncJob:
+    """Status and progress of one sync run, it is updated from the sync threads."""
+
+    def __init__(self, name, tables=(), trigger='api'):
+        self.id = uuid4().hex
+        self.name = name
+        self.trigger = trigger
+        self.tables = {table: 'queued' for table in tables}
+        self.status = 'queued'
+        self.rows_extracted = 0
+        self.rows_diffed = 0
+        self.rows_written = 0
+        self.errors = []
+        self.created_at = datetime.now()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def set_phase(self, table, phase):
+        with self.lock:
+            self.tables[table] = phase
+
+    def add(self, rows_extracted=0, rows_diffed=0, rows_written=0):
+        with self.lock:
+            self.rows_extracted += rows_extracted
+            self.rows_diffed += rows_diffed
+            self.rows_written += rows_written
+
+    def add_errors(self, errors):
+        with self.lock:
+            self.errors.extend(errors)
+
+    def elapsed(self):
+        if not self.started:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    def to_dict(self):
+        with self.lock:
+            elapsed = self.elapsed()
+            return {
+                'job_id': self.id,
+                'name': self.name,
+                'trigger': self.trigger,
+                'status': self.status,
+                'tables': dict(self.tables),
+                'rows_extracted': self.rows_extracted,
+                'rows_diffed': self.rows_diffed,
+                'rows_written': self.rows_written,
+                'elapsed_seconds': round(elapsed, 3),
+                'rows_per_second': round(self.rows_extracted / elapsed, 1) if elapsed else 0.0,
+                'errors': list(self.errors),
+                'created_at': self.created_at.isoformat()
+            }
+
+
+def claim_table(job, table):
+    """
+        Mark a table as syncing by the job.
+
+        Returns:
+        bool: False when another running job already syncs the table.
+    """
+
+    with registry_lock:
+        owner = active_tables.get(table)
+        if owner and owner != job.id:
+            return False
+        active_tables[table] = job.id
+    job.set_phase(table, 'starting')
+    return True
+
+
+def release_table(job, table):
+    with registry_lock:
+        if active_tables.get(table) == job.id:
+            del active_tables[table]
+
+
+def release_tables(job):
+    with registry_lock:
+        for table in [table for table, owner in active_tables.items() if owner == job.id]:
+            del active_tables[table]
+
+
+def start_job(job):
+    job.status = 'running'
+    job.started = time.monotonic()
+    logs(f"sync job {job.name} ({job.id}) is starting")
+
+
+def fail_job(job, e):
+    job.add_errors([f"Error in sync job {job.name}: {str(e)}"])
+    job.status = 'failed'
+    logs(f"Error in sync job {job.name} ({job.id}): {str(e)}", type="error")
+
+
+def finish_job(job):
+    job.finished = time.monotonic()
+    release_tables(job)
+    with registry_lock:
+        active_names.pop(job.name, None)
+    job.done.set()
+    logs(f"sync job {job.name} ({job.id}) is {job.status} in {job.elapsed():0.1f} sec")
+
+
+def result_status(job, result):
+    """Return the status of a finished job, skipped when another worker synced every one of its tables."""
+    if not result or job.errors:
+        return 'failed'
+    if job.tables and all(phase == 'skipped' for phase in job.tables.values()):
+        return 'skipped'
+    return 'done'
+
+
+def run_job(job, func):
+    start_job(job)
+    try:
+        result = func(job=job)
+        job.status = result_status(job, result)
+    except Exception as e:
+        fail_job(job, e)
+    finally:
+        finish_job(job)
+
+
+async def run_async_job(job, func):
+    start_job(job)
+    try:
+        result = await func(job=job)
+        job.status = result_status(job, result)
+    except Exception as e:
+        fail_job(job, e)
+    finally:
+        finish_job(job)
+
+
+def register_job(name, tables, trigger):
+    """Add a queued job to the registry, JobConflict is raised when the job or one of its tables is running."""
+    with registry_lock:
+        if name in active_names:
+            raise JobConflict(active_names[name], f"{name} is already running")
+        for table in tables:
+            if table in active_tables:
+                raise JobConflict(active_tables[table], f"{table} is already syncing")
+
+        job = SyncJob(name, tables, trigger)
+        jobs[job.id] = job
+        active_names[name] = job.id
+        for table in tables:
+            active_tables[table] = job.id
+
+        # forget the oldest finished jobs
+        finished = [old.id for old in jobs.values() if old.finished]
+        for job_id in finished[:max(0, len(finished) - SYNC_JOB_HISTORY)]:
+            del jobs[job_id]
+    return job
+
+
+def submit_job(name, func, tables=(), trigger='api'):
+    """
+        Start a sync in the background.
+
+        Parameters:
+        - name (str): The job name, only one job with a name runs at a time.
+        - func (callable): The sync function, it is called as func(job=job).
+        - tables (list, optional): The tables the job writes, known before it starts.
+        - trigger (str, optional): What started the job (api, schedule).
+
+        Returns:
+        SyncJob: The queued job. JobConflict is raised when the job or one of its tables is running.
+    """
+
+    job = register_job(name, tables, trigger)
+    job_pool.submit(run_job, job, func)
+    return job
+
+
+def submit_async_job(name, func, tables=(), trigger='api'):
+    """
+        Start a coroutine sync as a task on the running event loop, like submit_job.
+
+        Parameters:
+        - name (str): The job name, only one job with a name runs at a time.
+        - func (callable): The coroutine function, it is awaited as func(job=job).
+        - tables (list, optional): The tables the job writes, known before it starts.
+        - trigger (str, optional): What started the job (api, schedule).
+
+        Returns:
+        SyncJob: The queued job. JobConflict is raised when the job or one of its tables is running.
+    """
+
+    job = register_job(name, tables, trigger)
+    task = asyncio.get_running_loop().create_task(run_async_job(job, func))
+    job_tasks.add(task)
+    task.add_done_callback(job_tasks.discard)
+    return job
+
+
+def get_job(job_id):
+    return jobs.get(job_id)
+
+
+def list_jobs():
+    with registry_lock:
+        current = list(jobs.values())
+    return [job.to_dict() for job in current]
@@ -0,0 +1,240 @@
+import json
+import os
+import random
+import socket
+import threading
+from uuid import uuid4
+from scripts.extract import key_ranges
+from utils import logs, r11
+
+
+"""
+    this code makes sure only one worker of all the api processes and containers syncs a table
+    * a worker takes a lease on the table in redis before it syncs, the lease expires after
+      SYNC_LEASE_TTL seconds and is renewed in the background while the sync runs
+    * every lease gets a fencing token, a number which grows with every new lease of the table,
+      the token is written to the sync_fence table in the same transaction as the rows,
+      so a worker which lost its lease (e.g. it was paused) can't commit after the new owner
+    * a plan with "shards": n splits the integer keys of its table into n contiguous ranges,
+      every range has its own lease so several workers which start the same sync share it,
+      and every shard reads its range with an index range scan
+    * the workers which sync the shards of a table at the same time share a round, the first one
+      starts it in redis and the others join it, a shard done in the round is skipped by them,
+      once every shard is done the next run starts a new round and syncs all the shards again,
+      the key ranges are kept with the round so all its workers split the keys the same way
+    * a table without an integer key can't be split, it is synced by one worker
+"""
+
+# seconds a lease lives without being renewed
+SYNC_LEASE_TTL = int(os.environ.get('SYNC_LEASE_TTL', 60))
+SYNC_LEASES = os.environ.get('SYNC_LEASES', '1').lower() not in ('0', 'false', 'no')
+# seconds a round of shards which is not finished can be joined, a worker which died
+# leaves its shards undone, after this the next run starts a new round
+SYNC_SHARD_ROUND_SECONDS = int(os.environ.get('SYNC_SHARD_ROUND_SECONDS', 600))
+
+LEASE_KEY = 'table_sync:lease:{}'
+LEASE_TOKEN_KEY = 'table_sync:lease_token:{}'
+SHARD_ROUND_KEY = 'table_sync:shard_round:{}'
+SHARD_DONE_KEY = 'table_sync:shard_done:{}:{}'
+SHARD_RANGES_KEY = 'table_sync:shard_ranges:{}:{}'
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# the lease is changed only by its owner
+renew_script = r11.register_script("""
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return 0
+""")
+release_script = r11.register_script("""
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+""")
+# join the round of a table while some of its shards are not done, else start a new one
+round_script = r11.register_script("""
+    local round = redis.call('get', KEYS[1])
+    if round and redis.call('scard', ARGV[2] .. round) < tonumber(ARGV[3]) then
+        return round
+    end
+    redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[4])
+    return ARGV[1]
+""")
+
+FENCE_QUERY = """
+    INSERT INTO sync_fence (lease_name, token, updated_at) VALUES (%s, %s, NOW())
+    ON CONFLICT (lease_name) DO UPDATE SET token = EXCLUDED.token, updated_at = EXCLUDED.updated_at
+    WHERE sync_fence.token <= EXCLUDED.token
+    RETURNING token
+"""
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class Lease:
+    """A lease on a table (or a shard of it), renewed by a background thread until it is released."""
+
+    def __init__(self, name, token=None, owner=None):
+        self.name = name
+        self.token = token
+        self.owner = owner
+        self.lost = False
+        self.stopped = threading.Event()
+        self.renewer = None
+
+    def keep_alive(self):
+        self.renewer = threading.Thread(target=self.renew, name=f'lease_{self.name}', daemon=True)
+        self.renewer.start()
+        return self
+
+    def renew(self):
+        while not self.stopped.wait(SYNC_LEASE_TTL / 3):
+            try:
+                renewed = renew_script(keys=[LEASE_KEY.format(self.name)], args=[self.owner, SYNC_LEASE_TTL * 1000])
+            except Exception as e:
+                logs(f"Error renewing the lease of {self.name}: {str(e)}", type="warning")
+                continue
+            if not renewed:
+                self.lost = True
+                logs(f"lease of {self.name} is lost, the sync stops at the next batch", type="error")
+                return
+
+    def check(self):
+        """Raise LeaseLost when another worker may own the table now."""
+        if self.lost:
+            raise LeaseLost(f"lease of {self.name} is lost")
+
+    def release(self):
+        self.stopped.set()
+        if self.owner and not self.lost:
+            release_script(keys=[LEASE_KEY.format(self.name)], args=[self.owner])
+
+
+def acquire(name):
+    """
+        Take the lease of a table or shard.
+
+        Parameters:
+        - name (str): The lease name, the target table or table#shard/shards.
+
+        Returns:
+        Lease | None: The lease, None when another worker holds it. With SYNC_LEASES off
+        every call gets a lease without a token.
+    """
+
+    if not SYNC_LEASES:
+        return Lease(name)
+
+    owner = f"{WORKER_ID}:{uuid4().hex[:8]}"
+    if not r11.set(LEASE_KEY.format(name), owner, nx=True, px=SYNC_LEASE_TTL * 1000):
+        return None
+    token = r11.incr(LEASE_TOKEN_KEY.format(name))
+    return Lease(name, token, owner).keep_alive()
+
+
+def check_fence(cursor, lease):
+    """
+        Record the fencing token of the lease in the open transaction of cursor.
+
+        LeaseLost is raised when a newer lease of the table already wrote, the caller
+        rolls the transaction back.
+    """
+
+    if lease is None or lease.token is None:
+        return
+    lease.check()
+    cursor.execute(FENCE_QUERY, (lease.name, lease.token))
+    if cursor.fetchone() is None:
+        raise LeaseLost(f"lease {lease.name} with token {lease.token} is older than the last writer")
+
+
+def join_round(name, count):
+    """Return the id of the round of shards of a table this run takes part in."""
+    round_name = f"{name}/{count}"
+    round_id = round_script(
+        keys=[SHARD_ROUND_KEY.format(round_name)],
+        args=[uuid4().hex, SHARD_DONE_KEY.format(round_name, ''), count, SYNC_SHARD_ROUND_SECONDS]
+    )
+    return round_id.decode() if isinstance(round_id, bytes) else round_id
+
+
+def round_ranges(plan, key_sql, round_id):
+    """
+        Split the keys of a plan into one [lo, hi) range per shard, once per round.
+
+        The first worker of a round finds the ranges and saves them, the others use the saved ones.
+        The first range has no lower and the last no upper bound, so keys added later are read too.
+
+        Returns:
+        list | None: [(lo, hi), ...] with plan.shards ranges, None when the key is not an integer.
+    """
+
+    ranges_key = SHARD_RANGES_KEY.format(f"{plan.target_table}/{plan.shards}", round_id)
+    saved = r11.get(ranges_key)
+    if saved is None:
+        ranges = key_ranges(plan, key_sql, '', (), plan.shards)
+        if ranges:
+            # a range stays empty when there are fewer keys than shards
+            ranges += [(ranges[-1][1], ranges[-1][1])] * (plan.shards - len(ranges))
+            ranges[0] = (None, ranges[0][1])
+            ranges[-1] = (ranges[-1][0], None)
+        r11.set(ranges_key, json.dumps(ranges), nx=True, ex=SYNC_SHARD_ROUND_SECONDS)
+        saved = r11.get(ranges_key)
+    return json.loads(saved)
+
+
+class Shard:
+    """One contiguous range of the keys of a plan, in a round of the shards of the plan."""
+
+    def __init__(self, plan, index, count, round_id=None, lo=None, hi=None):
+        self.index = index
+        self.count = count
+        self.lo = lo
+        self.hi = hi
+        self.suffix = f"#{index}/{count}"
+        self.lease_name = plan.target_table + self.suffix
+        self.done_key = SHARD_DONE_KEY.format(f"{plan.target_table}/{count}", round_id)
+
+    def condition(self, key_sql):
+        conditions = []
+        if self.lo is not None:
+            conditions.append(f"{key_sql} >= {int(self.lo)}")
+        if self.hi is not None:
+            conditions.append(f"{key_sql} < {int(self.hi)}")
+        return ' AND '.join(conditions)
+
+    def is_done(self):
+        return bool(r11.sismember(self.done_key, self.index))
+
+    def mark_done(self):
+        r11.sadd(self.done_key, self.index)
+        r11.expire(self.done_key, SYNC_SHARD_ROUND_SECONDS)
+
+
+def plan_shards(plan, key_sql):
+    """
+        Return the shards of a plan in the order this worker tries them.
+
+        Parameters:
+        - plan (SyncPlan): The compiled plan.
+        - key_sql (str): The key column in the plan query (p.id with a join).
+
+        Returns:
+        list: The shards, [None] for an unsharded plan or a plan whose key is not an integer.
+    """
+
+    if plan.shards <= 1:
+        return [None]
+    round_id = join_round(plan.target_table, plan.shards)
+    ranges = round_ranges(plan, key_sql, round_id)
+    if not ranges:
+        logs(f"the keys of {plan.target_table} can't be split into shards, it is synced by one worker", type="warning")
+        return [None]
+    # workers start at different shards, so they don't all wait on the first one
+    start = random.randrange(plan.shards)
+    shards = [Shard(plan, index, plan.shards, round_id, lo, hi) for index, (lo, hi) in enumerate(ranges)]
+    return shards[start:] + shards[:start]
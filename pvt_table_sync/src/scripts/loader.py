@@ -0,0 +1,308 @@
+import io
+import os
+from datetime import date, datetime, time
+from config import engine, SessionLocal
+from utils import row_counts
+from scripts.diff import diff_rows
+from scripts.metrics import Phase
+from scripts.leases import check_fence
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session
+
+
+"""
+    this code loads a batch of rows into a postgres table in two statements
+    * the batch is copied into a temporary staging table with COPY FROM STDIN
+    * the staging table is merged into the target with INSERT ... ON CONFLICT (key) DO UPDATE,
+      rows which are equal to the target are skipped so they are not written again
+    * the columns which are not loaded get the python side default of the model (e.g. updated_by = "script")
+      on insert, like the orm does, an update leaves them as they are
+    * the key column must have a unique index in the target table,
+      orm_merge_rows is the slower fallback for targets without one
+    * the target rows of a batch are looked up with one array parameter for a few keys, many keys
+      are copied into a temporary table which is joined with the target, so postgres never
+      plans a statement with thousands of parameters
+"""
+
+# more keys than this are looked up through a temporary table
+LOOKUP_ARRAY_MAX_KEYS = int(os.environ.get('LOOKUP_ARRAY_MAX_KEYS', 1000))
+
+
+def quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def copy_value(value):
+    """Format a python value for the postgres COPY text format."""
+    if value is None or value != value:  # None, NaN and NaT are loaded as NULL
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime, date, time)):
+        value = value.isoformat()
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        value = '\\x' + bytes(value).hex()
+    else:
+        value = str(value)
+    return (
+        value.replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
+
+
+def copy_buffer(rows):
+    """Write row tuples into an in-memory file in the COPY text format."""
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join([copy_value(value) for value in row]))
+        buffer.write('\n')
+    buffer.seek(0)
+    return buffer
+
+
+def sql_literal(value):
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def insert_defaults(model, columns):
+    """Return {column: value} of the scalar python defaults of the model columns which are not in columns."""
+    return {
+        column.name: column.default.arg for column in model.__table__.columns
+        if column.name not in columns and column.default is not None and column.default.is_scalar
+    }
+
+
+def merge_query(target_table, staging_table, columns, key_column, defaults=None):
+    defaults = defaults or {}
+    cols = ', '.join(quote(column) for column in columns)
+    insert_cols = ', '.join([quote(column) for column in columns] + [quote(column) for column in defaults])
+    default_values = ''.join(f', {sql_literal(value)}' for value in defaults.values())
+    key = quote(key_column)
+    compared = [quote(column) for column in columns if column != key_column]
+
+    if not compared:
+        return f"""
+            WITH merged AS (
+                INSERT INTO {quote(target_table)} ({insert_cols})
+                SELECT {cols}{default_values} FROM {staging_table}
+                ON CONFLICT ({key}) DO NOTHING
+                RETURNING TRUE AS inserted
+            )
+            SELECT COUNT(*), 0 FROM merged
+        """
+
+    target_row = ', '.join(f'd.{column}' for column in compared)
+    staging_row = ', '.join(f's.{column}' for column in compared)
+    excluded_row = ', '.join(f'EXCLUDED.{column}' for column in compared)
+    current_row = ', '.join(f't.{column}' for column in compared)
+    assignments = ', '.join(f'{column} = EXCLUDED.{column}' for column in compared)
+
+    # unchanged rows are dropped before the INSERT, so they don't take a sequence value
+    # or lock the target row, the ON CONFLICT filter protects against concurrent writers
+    return f"""
+        WITH merged AS (
+            INSERT INTO {quote(target_table)} AS t ({insert_cols})
+            SELECT {', '.join(f's.{quote(column)}' for column in columns)}{default_values}
+            FROM {staging_table} s
+            LEFT JOIN {quote(target_table)} d ON d.{key} = s.{key}
+            WHERE d.{key} IS NULL OR ({target_row}) IS DISTINCT FROM ({staging_row})
+            ON CONFLICT ({key}) DO UPDATE SET {assignments}
+            WHERE ({current_row}) IS DISTINCT FROM ({excluded_row})
+            RETURNING (xmax = 0) AS inserted
+        )
+        SELECT COUNT(*) FILTER (WHERE inserted), COUNT(*) FILTER (WHERE NOT inserted) FROM merged
+    """
+
+
+def merge_rows(rows, target_table, columns, key_column, lease=None, defaults=None):
+    """
+        Copy rows into a staging table and merge them into the target table in one transaction.
+
+        Parameters:
+        - rows (list): Row tuples in the order of columns.
+        - target_table (str): The postgres table name.
+        - columns (list): The target column names, it must contain key_column.
+        - key_column (str): The column with a unique index used to match the rows.
+        - lease (Lease, optional): The lease of the sync, its fencing token is checked before the commit.
+        - defaults (dict, optional): The values of the other columns of inserted rows, from insert_defaults.
+
+        Returns:
+        tuple: (inserted, updated) row counts.
+    """
+
+    staging_table = quote(f'_stage_{target_table}')
+    cols = ', '.join(quote(column) for column in columns)
+
+    con = engine.raw_connection()
+    try:
+        cursor = con.cursor()
+        with Phase(target_table, 'load', rows_in=len(rows), round_trips=3) as measured:
+            cursor.execute(
+                f"CREATE TEMP TABLE {staging_table} ON COMMIT DROP AS "
+                f"SELECT {cols} FROM {quote(target_table)} WITH NO DATA"
+            )
+            cursor.copy_expert(f"COPY {staging_table} ({cols}) FROM STDIN", copy_buffer(rows))
+            cursor.execute(merge_query(target_table, staging_table, columns, key_column, defaults))
+            inserted, updated = cursor.fetchone()
+            measured.rows_out = inserted + updated
+        check_fence(cursor, lease)
+        with Phase(target_table, 'commit', round_trips=1):
+            con.commit()
+        cursor.close()
+        return inserted, updated
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        con.close()  # the connection goes back to the engine pool
+
+
+def lookup_rows(cursor, target_table, columns, key_column, keys):
+    """
+        Read the given columns of the target rows which have one of the keys.
+
+        Parameters:
+        - cursor: A psycopg2 cursor, the temporary key table lives until its transaction ends.
+        - target_table (str): The postgres table name.
+        - columns (list): The columns to read.
+        - key_column (str): The column to match the keys on.
+        - keys (list): The key values.
+
+        Returns:
+        tuple: (rows, round trips) where rows are plain tuples in the order of columns.
+    """
+
+    if not keys:
+        return [], 0
+
+    select = ', '.join(f't.{quote(column)}' for column in columns)
+    key = quote(key_column)
+    if len(keys) <= LOOKUP_ARRAY_MAX_KEYS:
+        cursor.execute(f"SELECT {select} FROM {quote(target_table)} t WHERE t.{key} = ANY(%s)", (list(keys),))
+        return cursor.fetchall(), 1
+
+    keys_table = quote(f'_lookup_{target_table}')
+    cursor.execute(
+        f"CREATE TEMP TABLE {keys_table} ON COMMIT DROP AS "
+        f"SELECT {key} FROM {quote(target_table)} WITH NO DATA"
+    )
+    cursor.copy_expert(f"COPY {keys_table} ({key}) FROM STDIN", copy_buffer((value,) for value in keys))
+    # the row count of the key table lets postgres pick a hash join instead of a nested loop
+    cursor.execute(f"ANALYZE {keys_table}")
+    cursor.execute(f"SELECT {select} FROM {quote(target_table)} t JOIN {keys_table} k ON k.{key} = t.{key}")
+    rows = cursor.fetchall()
+    cursor.execute(f"DROP TABLE {keys_table}")
+    return rows, 5
+
+
+def delete_rows(target_table, key_column, keys, lease=None):
+    """
+        Delete the rows with the given keys from the target table.
+
+        Parameters:
+        - target_table (str): The postgres table name.
+        - key_column (str): The column used to match the rows.
+        - keys (list): The key values of the deleted rows.
+        - lease (Lease, optional): The lease of the sync, its fencing token is checked before the commit.
+
+        Returns:
+        int: The number of deleted rows.
+    """
+
+    if not keys:
+        return 0
+
+    con = engine.raw_connection()
+    try:
+        cursor = con.cursor()
+        with Phase(target_table, 'load', rows_in=len(keys), round_trips=1) as measured:
+            cursor.execute(
+                f"DELETE FROM {quote(target_table)} WHERE {quote(key_column)} = ANY(%s)", (list(keys),)
+            )
+            deleted = measured.rows_out = cursor.rowcount
+        check_fence(cursor, lease)
+        with Phase(target_table, 'commit', round_trips=1):
+            con.commit()
+        cursor.close()
+        return deleted
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        con.close()  # the connection goes back to the engine pool
+
+
+def orm_merge_rows(rows, model_name, columns, key_column, lease=None):
+    """
+        Insert or update rows through the ORM, for targets without a unique index on the key.
+
+        The matching target rows are read as plain tuples (see lookup_rows) and compared with
+        the batch column by column in data frames, only the changed rows are saved.
+
+        Parameters:
+        - rows (list): Row tuples in the order of columns.
+        - model_name: The target SQLAlchemy model.
+        - columns (list): The target column names, it must contain key_column.
+        - key_column (str): The column used to match the rows.
+        - lease (Lease, optional): The lease of the sync, its fencing token is checked before the commit.
+
+        Returns:
+        tuple: (inserted, updated) row counts.
+    """
+
+    db: Session = SessionLocal()
+    target_table = model_name.__tablename__
+    try:
+        key_index = columns.index(key_column)
+        # the primary key is read too, the updates are matched on it
+        primary_keys = [column.key for column in inspect(model_name).primary_key if column.key not in columns]
+        target_columns = columns + primary_keys
+        with Phase(target_table, 'target_lookup', rows_in=len(rows)) as measured:
+            # the lookup runs in the transaction of the session
+            cursor = db.connection().connection.cursor()
+            existing_rows, measured.round_trips = lookup_rows(
+                cursor, target_table, target_columns, key_column, [row[key_index] for row in rows]
+            )
+            measured.rows_out = len(existing_rows)
+
+        with Phase(target_table, 'diff', rows_in=len(rows)) as measured:
+            insert_keys, update_keys, _ = diff_rows(rows, existing_rows, columns, key_column, target_columns)
+            measured.rows_out = len(insert_keys) + len(update_keys)
+
+        rows_by_key = {row[key_index]: row for row in rows}
+        to_insert = [dict(zip(columns, rows_by_key[key])) for key in insert_keys]
+        to_update = []
+        if update_keys:
+            ids = {row[key_index]: row[len(columns):] for row in existing_rows}
+            to_update = [
+                dict(zip(columns, rows_by_key[key]), **dict(zip(primary_keys, ids[key]))) for key in update_keys
+            ]
+        with Phase(target_table, 'load', rows_in=len(to_insert) + len(to_update)) as measured:
+            if to_update:
+                db.bulk_update_mappings(model_name, to_update)  # Bulk update existing records
+                measured.round_trips += 1
+            if to_insert:
+                db.bulk_insert_mappings(model_name, to_insert)  # Bulk insert new records
+                measured.round_trips += 1
+            measured.rows_out = measured.rows_in
+
+        if lease is not None:
+            # the fence is written in the transaction of the session
+            check_fence(db.connection().connection.cursor(), lease)
+        with Phase(target_table, 'commit', round_trips=1):
+            db.commit()  # Commit the transaction
+        # the rows are counted by the caller, only a share of the keys is logged
+        row_counts.sample(target_table, 'inserted', insert_keys, key_column)
+        row_counts.sample(target_table, 'updated', update_keys, key_column)
+        return len(to_insert), len(to_update)
+    except Exception:
+        db.rollback()  # Rollback the session on error
+        raise
+    finally:
+        db.close()  # session is closed
@@ -0,0 +1,141 @@
+import time
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+
+"""
+    this code measures every phase of a sync run and keeps the numbers for the /metrics endpoint
+    * the phases are extract (mysql reads), merge (joins of supporting tables), dedupe,
+      diff (fingerprint filter), target_lookup (reading the target rows), load and commit
+    * every phase records its seconds in a histogram per table and phase, and counts the rows
+      going in and out, the bytes fetched and the database round trips
+    * the bytes of a batch are estimated from a sample of its rows, so measuring stays cheap
+"""
+
+PHASE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+RUN_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+# rows measured to estimate the size of a batch
+BYTES_SAMPLE_ROWS = 50
+
+phase_seconds = Histogram(
+    'table_sync_phase_seconds', 'Seconds spent in a sync phase', ['table', 'phase'], buckets=PHASE_BUCKETS
+)
+phase_rows_in = Counter('table_sync_phase_rows_in', 'Rows given to a sync phase', ['table', 'phase'])
+phase_rows_out = Counter('table_sync_phase_rows_out', 'Rows produced by a sync phase', ['table', 'phase'])
+phase_bytes = Counter('table_sync_phase_bytes', 'Estimated bytes fetched by a sync phase', ['table', 'phase'])
+phase_round_trips = Counter('table_sync_phase_round_trips', 'Database round trips of a sync phase', ['table', 'phase'])
+run_seconds = Histogram('table_sync_run_seconds', 'Seconds of a table sync run', ['table'], buckets=RUN_BUCKETS)
+run_failures = Counter('table_sync_run_failures', 'Failed table sync runs', ['table'])
+
+
+def estimate_bytes(records):
+    """Estimate the size of a batch of dictionaries or tuples from its first rows."""
+    if not records:
+        return 0
+    sample = records[:BYTES_SAMPLE_ROWS]
+    size = 0
+    for record in sample:
+        values = record.values() if isinstance(record, dict) else record
+        size += sum(len(str(value)) for value in values if value is not None)
+    return int(size * len(records) / len(sample))
+
+
+def observe(table, phase, seconds, rows_in=0, rows_out=0, bytes_fetched=0, round_trips=0):
+    """Record one measurement of a phase."""
+    phase_seconds.labels(table, phase).observe(seconds)
+    if rows_in:
+        phase_rows_in.labels(table, phase).inc(rows_in)
+    if rows_out:
+        phase_rows_out.labels(table, phase).inc(rows_out)
+    if bytes_fetched:
+        phase_bytes.labels(table, phase).inc(bytes_fetched)
+    if round_trips:
+        phase_round_trips.labels(table, phase).inc(round_trips)
+
+
+def observe_run(job, table, seconds):
+    """Record a table sync run, a run skipped because another worker held the table is not a run."""
+    phase = job.tables.get(table)
+    if phase == 'skipped':
+        return
+    run_seconds.labels(table).observe(seconds)
+    if phase == 'failed':
+        run_failures.labels(table).inc()
+
+
+class Phase:
+    """
+        Measure a block as a phase of a table sync.
+
+        with Phase(table, 'dedupe', rows_in=len(records)) as measured:
+            rows = plan.to_rows(records)
+            measured.rows_out = len(rows)
+    """
+
+    def __init__(self, table, phase, rows_in=0, round_trips=0):
+        self.table = table
+        self.phase = phase
+        self.rows_in = rows_in
+        self.rows_out = 0
+        self.bytes_fetched = 0
+        self.round_trips = round_trips
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(
+            self.table, self.phase, time.perf_counter() - self.start,
+            self.rows_in, self.rows_out, self.bytes_fetched, self.round_trips
+        )
+        return False
+
+
+class TimedBatches:
+    """
+        Measure a stream of batches as a phase, every batch is one observation.
+
+        Parameters:
+        - batches (iterable): The batches of rows.
+        - table (str): The target table.
+        - phase (str): The phase name.
+        - inner (TimedBatches, optional): The measured stream this one reads from,
+          its time is not counted again.
+        - fetched (bool, optional): The batches come from a database, count their bytes and round trips.
+    """
+
+    def __init__(self, batches, table, phase, inner=None, fetched=False):
+        self.batches = iter(batches)
+        self.table = table
+        self.phase = phase
+        self.inner = inner
+        self.fetched = fetched
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        inner_seconds = self.inner.seconds if self.inner else 0.0
+        start = time.perf_counter()
+        try:
+            records = next(self.batches)
+        except StopIteration:
+            self.seconds += time.perf_counter() - start
+            raise
+        elapsed = time.perf_counter() - start
+        self.seconds += elapsed
+        if self.inner:
+            elapsed -= self.inner.seconds - inner_seconds
+
+        observe(
+            self.table, self.phase, elapsed, rows_out=len(records),
+            bytes_fetched=estimate_bytes(records) if self.fetched else 0,
+            round_trips=1 if self.fetched else 0
+        )
+        return records
+
+
+def latest():
+    """Return the metrics in the prometheus text format and its content type."""
+    return generate_latest(), CONTENT_TYPE_LATEST
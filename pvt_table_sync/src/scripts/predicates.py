@@ -0,0 +1,135 @@
+import operator
+from datetime import date, datetime
+
+
+"""
+    this code evaluates the declarative row filters of the sync plans and turns them into sql
+    a filter is a list of [column, operator, value] conditions which must all be true, e.g.
+    [["status", "=", "active"], ["site_id", "in", ["a", "b"]], ["timestamp", ">=", "2024-01-01"], ["pan_no", "is not null"]]
+    * operators: =, !=, <, <=, >, >=, in, not in, is null, is not null
+    * a condition on a null value is false like in sql, except is null
+    * a date or datetime column is compared with the iso format string of the filter as a date
+    * where_sql gives the same conditions as a mysql WHERE condition with parameters, so the
+      source query only returns the rows which pass
+"""
+
+OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda value, values: value in values,
+    'not in': lambda value, values: value not in values
+}
+NULL_OPERATORS = ('is null', 'is not null')
+
+
+def parse_filter(conditions):
+    """
+        Check the conditions of a filter.
+
+        Returns:
+        list: (column, operator, value) tuples, value is a tuple for in / not in and None for the null checks.
+    """
+
+    parsed = []
+    for condition in conditions or []:
+        if not isinstance(condition, list) or len(condition) not in (2, 3):
+            raise ValueError(f"filter condition {condition} is not [column, operator, value]")
+        column, op, *value = condition
+        op = str(op).lower()
+        if op in NULL_OPERATORS:
+            if value:
+                raise ValueError(f"filter condition {condition} takes no value")
+            parsed.append((column, op, None))
+            continue
+        if op not in OPERATORS or not value:
+            raise ValueError(f"filter condition {condition} is not valid")
+        value = value[0]
+        if op in ('in', 'not in'):
+            if not isinstance(value, list) or not value:
+                raise ValueError(f"filter condition {condition} needs a list of values")
+            value = tuple(value)
+        parsed.append((column, op, value))
+    return parsed
+
+
+def coerce(value, like):
+    """Turn an iso format string into a date / datetime when the source value is one."""
+    if isinstance(value, str):
+        if isinstance(like, datetime):
+            return datetime.fromisoformat(value)
+        if isinstance(like, date):
+            return date.fromisoformat(value)
+    return value
+
+
+def condition_check(column, op, value):
+    if op == 'is null':
+        return lambda record: record.get(column) is None
+    if op == 'is not null':
+        return lambda record: record.get(column) is not None
+
+    compare = OPERATORS[op]
+    if op in ('in', 'not in'):
+        values = set(value)
+        return lambda record: record.get(column) is not None and compare(record[column], values)
+
+    def check(record):
+        current = record.get(column)
+        return current is not None and compare(current, coerce(value, current))
+    return check
+
+
+def row_filter(conditions):
+    """
+        Build the function which tells if a source record (a dictionary) passes the filter.
+
+        Returns:
+        function | None: None when there are no conditions.
+    """
+
+    checks = [condition_check(*condition) for condition in parse_filter(conditions)]
+    if not checks:
+        return None
+    if len(checks) == 1:
+        return checks[0]
+    return lambda record: all(check(record) for check in checks)
+
+
+def where_sql(conditions, qualify=None):
+    """
+        Build the sql of filter conditions.
+
+        Parameters:
+        - conditions (list): The [column, operator, value] conditions.
+        - qualify (function, optional): Gives the column reference in the query (e.g. p.status) of a column name.
+
+        Returns:
+        tuple: (sql, params) without the WHERE keyword, ('', ()) without conditions.
+    """
+
+    parts = []
+    params = []
+    for column, op, value in parse_filter(conditions):
+        reference = qualify(column) if qualify else column
+        if op in NULL_OPERATORS:
+            parts.append(f"{reference} {op.upper()}")
+        elif op in ('in', 'not in'):
+            parts.append(f"{reference} {op.upper()} ({', '.join(['%s'] * len(value))})")
+            params += value
+        else:
+            parts.append(f"{reference} {op} %s")
+            params.append(value)
+    return ' AND '.join(parts), tuple(params)
+
+
+def add_condition(where, params, condition):
+    """Append a (sql, params) condition from where_sql to a ' WHERE ...' clause and its params."""
+    sql, condition_params = condition
+    if not sql:
+        return where, params
+    where = f"{where} AND {sql}" if where else f" WHERE {sql}"
+    return where, tuple(params) + tuple(condition_params)
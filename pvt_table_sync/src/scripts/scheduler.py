@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+from functools import partial
+from apscheduler.schedulers.background import BackgroundScheduler
+from utils import logs
+from scripts.jobs import submit_job, JobConflict
+from scripts.sync_engine import load_plans, run_plans
+
+
+"""
+    this code runs the plans on their own schedule inside the api process
+    * every plan is a scheduled job with its own interval, a run is a normal sync job,
+      so it shows up in /sync-jobs and can't overlap a manual run of the same table
+    * after every run the interval is adapted: a table without changes is synced less often,
+      a table with changes more often, but never more often than twice its run time
+    * the sum of run time / interval of all the tables is the share of time the source
+      databases are busy with scheduled syncs, it is kept under SYNC_SCHEDULE_LOAD_BUDGET
+      by stretching every interval
+    a plan can set its own "schedule": {"interval", "min_interval", "max_interval"} (seconds)
+    or "schedule": false to stay on the manual / cron endpoints only,
+    the targets of a definition with "targets" are scheduled together, so their source is read once
+"""
+
+# start the scheduler with the api, the cron jobs calling the endpoints can be dropped then
+SYNC_SCHEDULER = os.environ.get('SYNC_SCHEDULER', '').lower() in ('1', 'true', 'yes')
+SYNC_SCHEDULE_INTERVAL = int(os.environ.get('SYNC_SCHEDULE_INTERVAL', 900))
+SYNC_SCHEDULE_MIN_INTERVAL = int(os.environ.get('SYNC_SCHEDULE_MIN_INTERVAL', 60))
+SYNC_SCHEDULE_MAX_INTERVAL = int(os.environ.get('SYNC_SCHEDULE_MAX_INTERVAL', 6 * 3600))
+# share of the time the source databases may spend in scheduled syncs
+SYNC_SCHEDULE_LOAD_BUDGET = float(os.environ.get('SYNC_SCHEDULE_LOAD_BUDGET', 0.25))
+# a run which changes at least this share of the read rows is a hot table
+HOT_CHANGE_RATIO = 0.01
+# weight of the last run in the averaged run time
+DURATION_WEIGHT = 0.3
+
+
+class TableSchedule:
+    """The interval and the observed behaviour of one scheduled plan."""
+
+    def __init__(self, name, tables, settings):
+        self.name = name
+        self.tables = tables
+        self.min_interval = settings.get('min_interval', SYNC_SCHEDULE_MIN_INTERVAL)
+        self.max_interval = settings.get('max_interval', SYNC_SCHEDULE_MAX_INTERVAL)
+        self.interval = min(max(settings.get('interval', SYNC_SCHEDULE_INTERVAL), self.min_interval), self.max_interval)
+        self.duration = 0.0
+        self.change_ratio = None
+        self.runs = 0
+        self.last_run = None
+        self.last_status = None
+        self.last_job_id = None
+
+    def adapt(self, job):
+        """Set the next interval from the result of a run."""
+        self.last_run = time.time()
+        self.last_status = job.status
+        self.last_job_id = job.id
+        if job.status == 'skipped':
+            # the scheduler of another replica synced the tables, it says nothing about the source
+            return
+        self.runs += 1
+        elapsed = job.elapsed()
+        self.duration = elapsed if self.runs == 1 else (
+            DURATION_WEIGHT * elapsed + (1 - DURATION_WEIGHT) * self.duration
+        )
+
+        if job.status != 'done':
+            # don't hammer a failing source
+            interval = self.interval * 2
+        else:
+            self.change_ratio = job.rows_written / job.rows_extracted if job.rows_extracted else 0.0
+            if not job.rows_written:
+                interval = self.interval * 1.5
+            elif self.change_ratio >= HOT_CHANGE_RATIO:
+                interval = self.interval / 2
+            else:
+                interval = self.interval * 0.75
+
+        self.interval = min(max(interval, self.min_interval, self.duration * 2), self.max_interval)
+
+    def load(self):
+        return self.duration / self.interval if self.interval else 0.0
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'table': ', '.join(self.tables),
+            'interval_seconds': round(self.interval, 1),
+            'avg_run_seconds': round(self.duration, 3),
+            'change_ratio': round(self.change_ratio, 5) if self.change_ratio is not None else None,
+            'runs': self.runs,
+            'last_status': self.last_status,
+            'last_job_id': self.last_job_id
+        }
+
+
+class AdaptiveScheduler:
+    """Run every scheduled plan as a background job and adapt its interval after each run."""
+
+    def __init__(self):
+        self.scheduler = None
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.scheduler:
+            return
+        plans, _ = load_plans()
+        self.scheduler = BackgroundScheduler(job_defaults={'coalesce': True, 'max_instances': 1})
+        for plan in plans:
+            settings = plan.schedule
+            name = plan.fanout or plan.name
+            if settings is False or name in self.tables:
+                continue
+            tables = [other.target_table for other in plans if (other.fanout or other.name) == name]
+            schedule = TableSchedule(name, tables, settings if isinstance(settings, dict) else {})
+            self.tables[name] = schedule
+            self.scheduler.add_job(
+                self.run, 'interval', seconds=schedule.interval, args=[name], id=name
+            )
+        self.scheduler.start()
+        logs(f"sync scheduler is started for {sorted(self.tables)}")
+
+    def shutdown(self):
+        if self.scheduler:
+            self.scheduler.shutdown(wait=False)
+            self.scheduler = None
+
+    def run(self, name):
+        schedule = self.tables[name]
+        try:
+            job = submit_job(name, partial(run_plans, None, name=name), tables=schedule.tables, trigger='schedule')
+        except JobConflict as e:
+            logs(f"scheduled sync of {name} is skipped: {e.detail}", type="warning")
+            return
+
+        job.done.wait()
+        with self.lock:
+            old_intervals = {table.name: table.interval for table in self.tables.values()}
+            schedule.adapt(job)
+            self.balance()
+            changed = [
+                table for table in self.tables.values() if abs(table.interval - old_intervals[table.name]) >= 1
+            ]
+        for table in changed:
+            self.scheduler.reschedule_job(table.name, trigger='interval', seconds=round(table.interval))
+            logs(f"{table.name} is synced every {table.interval:0.0f} sec now")
+
+    def balance(self):
+        """Stretch every interval when the scheduled syncs would keep the sources busier than the budget."""
+        load = sum(table.load() for table in self.tables.values())
+        if load <= SYNC_SCHEDULE_LOAD_BUDGET:
+            return
+        factor = load / SYNC_SCHEDULE_LOAD_BUDGET
+        for table in self.tables.values():
+            table.interval = min(table.interval * factor, table.max_interval)
+
+    def status(self):
+        with self.lock:
+            tables = [table.to_dict() for table in self.tables.values()]
+        for table in tables:
+            scheduled = self.scheduler.get_job(table['name']) if self.scheduler else None
+            table['next_run'] = scheduled.next_run_time.isoformat() if scheduled and scheduled.next_run_time else None
+        return {
+            'running': self.scheduler is not None,
+            'load': round(sum(table['avg_run_seconds'] / table['interval_seconds'] for table in tables), 4),
+            'load_budget': SYNC_SCHEDULE_LOAD_BUDGET,
+            'tables': tables
+        }
+
+
+scheduler = AdaptiveScheduler()
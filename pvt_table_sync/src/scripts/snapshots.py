@@ -0,0 +1,86 @@
+import os
+import threading
+import time
+from config import stream_db_data
+from utils import logs
+
+
+"""
+    this code keeps the build side of a supporting table join in memory between runs
+    * a supporting source with "snapshot" in its plan is read once into a hash join and the
+      joined dict is kept for the next runs of the plan
+    * before a run reuses it, a cheap change signal is read from mysql: COUNT(*) and MAX() of the
+      signal_column of the source, or CHECKSUM TABLE when the source has no such column,
+      a different signal builds the snapshot again
+    * a snapshot older than its ttl is dropped, so a missed change is never kept forever
+    * a build side which spilled to disk is not kept
+    "snapshot": true or {"ttl": seconds, "signal_column": "updated_at"}
+"""
+
+# seconds a supporting table snapshot is reused at most
+SYNC_SNAPSHOT_TTL = int(os.environ.get('SYNC_SNAPSHOT_TTL', 3600))
+
+
+class Snapshot:
+    def __init__(self, signal, table, ttl):
+        self.signal = signal
+        self.table = table
+        self.expires_at = time.monotonic() + ttl
+
+
+snapshots = {}
+snapshots_lock = threading.Lock()
+
+
+def snapshot_settings(source):
+    settings = source.get('snapshot')
+    if not settings:
+        return None
+    return settings if isinstance(settings, dict) else {}
+
+
+def snapshot_key(source, columns):
+    return (source.get('server', 'legacy'), source['table_key'], source['merging_on'], tuple(columns), source['condition'])
+
+
+def change_signal(source, settings):
+    """Read the change signal of a source table, a tuple which changes when the table changes."""
+    column = settings.get('signal_column')
+    if column:
+        query = f"SELECT COUNT(*), MAX({column}) FROM {source['table_key']}"
+    else:
+        query = f"CHECKSUM TABLE {source['table_key']}"
+    signal = []
+    for rows in stream_db_data(query, is_dict=False, server=source.get('server', 'legacy')):
+        signal += rows
+    return tuple(str(value) for value in signal[0]) if signal else None
+
+
+def evict_expired():
+    now = time.monotonic()
+    with snapshots_lock:
+        for key in [key for key, snapshot in snapshots.items() if snapshot.expires_at <= now]:
+            del snapshots[key]
+
+
+def get_snapshot(key, signal):
+    """Return the cached build side of a join or None when it is missing, expired or the table changed."""
+    evict_expired()
+    with snapshots_lock:
+        snapshot = snapshots.get(key)
+    if snapshot is None or signal is None or snapshot.signal != signal:
+        return None
+    return snapshot.table
+
+
+def save_snapshot(key, signal, table, settings):
+    if signal is None:
+        return
+    with snapshots_lock:
+        snapshots[key] = Snapshot(signal, table, settings.get('ttl', SYNC_SNAPSHOT_TTL))
+    logs(f"snapshot of {key[1]} is kept with {len(table)} rows")
+
+
+def clear_snapshots():
+    with snapshots_lock:
+        snapshots.clear()
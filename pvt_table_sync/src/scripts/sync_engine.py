@@ -0,0 +1,799 @@
+import json
+import os
+import sys
+import threading
+import time
+from functools import partial
+from operator import itemgetter
+import models
+from config import stream_db_data, SYNC_PLANS_FILE
+from utils import logs, row_counts
+from scripts.executor import run_jobs
+from scripts.extract import key_ranges, parallel_stream, RANGES_PER_READER, SYNC_EXTRACT_READERS
+from scripts.hash_join import HashJoin
+from scripts.jobs import SyncJob, claim_table, release_table
+from scripts.leases import acquire, plan_shards
+from scripts.loader import merge_rows, orm_merge_rows, insert_defaults
+from scripts.predicates import parse_filter, row_filter, where_sql, add_condition
+from scripts.metrics import Phase, TimedBatches, observe, observe_run
+from scripts.snapshots import snapshot_settings, snapshot_key, change_signal, get_snapshot, save_snapshot
+from scripts.sync_state import (
+    watermark_clause, max_watermark, set_watermark, filter_changed, save_fingerprints,
+    start_checkpoint, get_checkpoint, save_checkpoint, clear_checkpoint, advance_checkpoint, pending_ranges
+)
+
+
+"""
+    this code syncs the tables described in sync_plans.json from the legacy mysql to postgres
+    every plan has
+    * name: the plan name, group: the api / job which runs it
+    * enabled: false keeps a plan in the file without compiling or running it
+      (user_meter_detail waits for its model in models.py)
+    * model: the target model name in models.py
+    * sources: the source tables, the first one gives all the rows and the others are supporting
+      tables which give the remaining values (db_name, table_name, select_columns, primary_column
+      to dedupe on, merging_on to join on, watermark_column for incremental syncs on the first table,
+      server: the mysql server of the table, the legacy server by default, snapshot: keep the
+      supporting table in memory between runs while it doesn't change, see scripts/snapshots.py,
+      where: [column, operator, value] conditions added to the query of the table)
+    * key_column: the source column which identifies a row, it must be in the column_mapping
+    * column_mapping: source column name: target column name, null to sync the source columns
+      which the target model has (only those are selected)
+    * load_strategy: copy (COPY into staging + INSERT ON CONFLICT) or orm (compare and bulk save objects)
+    * fingerprint_cache: skip the rows whose hash is unchanged since their last commit
+    * cdc: also keep the table in sync from the mysql binlog (scripts/cdc.py)
+    * schedule: the intervals of the in-process scheduler (scripts/scheduler.py), false to not schedule it
+    * shards: split the integer keys into this many ranges which workers on several replicas sync in parallel
+    * readers: the number of connections reading the first table at the same time in integer key ranges
+    * checkpoint: read the first table in key order and save the last committed key after every batch,
+      a failed or interrupted run is continued from there by the next run instead of starting again
+    * filter: [column, operator, value] conditions a source row must pass to be synced, see scripts/predicates.py,
+      they are pushed into the source query when they are on columns of the first table
+    * targets: several targets fed by one read of the sources, every target is a plan of its own
+      (name, model, key_column, column_mapping, filter, load_strategy ...) and gets the other keys
+      of the definition, every batch is read once and written to each target in turn
+    a plan is compiled once into its queries and column maps and reused until the file changes
+    when all the sources are on one server the join is pushed down to mysql as a single LEFT JOIN
+    query which reads only the needed columns, otherwise (or when a supporting table is kept as a
+    snapshot) the supporting tables are read into hash joins and the first table is streamed through them
+"""
+
+
+COLUMNS_QUERY = """
+    SELECT COLUMN_NAME FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s ORDER BY ORDINAL_POSITION
+"""
+
+
+class SyncPlan:
+    """A compiled sync definition: the source queries and the row layout of the target."""
+
+    def __init__(self, definition):
+        self.name = definition['name']
+        self.group = definition.get('group', self.name)
+
+        # a plan built in code (e.g. the benchmarks) can pass the model class itself
+        model = definition['model']
+        self.model = model if isinstance(model, type) else getattr(models, model, None)
+        if self.model is None:
+            raise ValueError(f"model {model} is not defined in models.py")
+        self.target_table = self.model.__tablename__
+        self.model_columns = [column.name for column in self.model.__table__.columns]
+
+        if not definition.get('sources'):
+            raise ValueError("no source table is given")
+        self.sources = []
+        for source in definition['sources']:
+            source = dict(source)
+            source['table_key'] = f"{source['db_name'].rstrip('.')}.{source['table_name']}"
+            columns = source.get('select_columns')
+            source['query'] = f"SELECT {', '.join(columns) if columns else '*'} FROM {source['table_key']}"
+            # the where of a table read on its own (a hash join build side)
+            source['condition'] = where_sql(source.get('where'))
+            self.sources.append(source)
+        self.primary = self.sources[0]
+        self.supporting = self.sources[1:]
+        self.db_names = sorted({source['db_name'].rstrip('.') for source in self.sources})
+
+        self.key_column = definition['key_column']
+        self.watermark_column = self.primary.get('watermark_column')
+        self.load_strategy = definition.get('load_strategy', 'copy')
+        self.fingerprint_cache = definition.get('fingerprint_cache', True)
+        self.cdc = definition.get('cdc', False)
+        self.schedule = definition.get('schedule', {})
+        self.shards = int(definition.get('shards') or 1)
+        self.readers = int(definition.get('readers') or SYNC_EXTRACT_READERS)
+        self.checkpoint = definition.get('checkpoint', False)
+        self.filter = row_filter(definition.get('filter'))
+        self.filter_columns = [column for column, _, _ in parse_filter(definition.get('filter'))]
+        # the name of the definition with targets this plan is one of, and the plan which reads for all of them
+        self.fanout = definition.get('fanout')
+        self.reader = None
+
+        for source in self.supporting:
+            if not source.get('merging_on') or not self.primary.get('merging_on'):
+                raise ValueError(f"merging_on is missing for {source['table_key']}")
+
+        self.column_mapping = definition.get('column_mapping')
+
+        self.server = self.primary.get('server', 'legacy')
+        self.pushdown = bool(self.supporting) and all(
+            source.get('server', 'legacy') == self.server and not source.get('snapshot') for source in self.sources
+        )
+        if self.supporting and not self.pushdown:
+            for source in self.supporting:
+                if not source.get('select_columns'):
+                    raise ValueError(
+                        f"select_columns is needed for {source['table_key']} on another server or in a snapshot"
+                    )
+            if self.checkpoint:
+                # the hash join may spill and yield the rows out of key order
+                raise ValueError("checkpoint needs all the sources on one server")
+
+        # the params of the where of the supporting tables in the joins of a pushed down query
+        self.query_params = ()
+        if self.pushdown:
+            self.query = self.join_query()
+            self.watermark_sql = f"p.{self.watermark_column}" if self.watermark_column else None
+        else:
+            self.query = self.primary['query']
+            self.watermark_sql = self.watermark_column
+
+        # the where of the first table and the filter when it is on columns of the first table go into the query
+        conditions = list(self.primary.get('where') or [])
+        primary_columns = self.primary.get('select_columns') or []
+        if not self.supporting or all(column in primary_columns for column in self.filter_columns):
+            conditions += definition.get('filter') or []
+        self.condition = where_sql(conditions, (lambda column: f"p.{column}") if self.pushdown else None)
+
+        self.getter = None
+        if not self.supporting and not primary_columns and self.column_mapping:
+            # the mapped columns are all the plan reads from the table
+            self.select(list(self.column_mapping))
+        if not self.supporting and primary_columns and not self.column_mapping:
+            self.project([column for column in primary_columns if column in self.model_columns])
+        if self.column_mapping:
+            selected = {
+                column for source in self.sources for column in (source.get('select_columns') or [])
+            }
+            if all(source.get('select_columns') for source in self.sources):
+                missing = [column for column in [*self.column_mapping, *self.filter_columns] if column not in selected]
+                if missing:
+                    raise ValueError(f"mapped columns {missing} are not selected from the sources")
+            self.bind(list(self.column_mapping))
+
+    def join_query(self):
+        """
+            Build one LEFT JOIN query for sources which share a server.
+
+            Only the mapped columns of the supporting tables are read. Unlike the client side
+            merge, a key repeated in a supporting table repeats the row, the rows are then
+            deduplicated on the key like any other batch.
+        """
+
+        needed = set(self.column_mapping) | set(self.filter_columns) if self.column_mapping else None
+        primary_columns = self.primary.get('select_columns')
+        select = [f"p.{column} AS {column}" for column in primary_columns] if primary_columns else ['p.*']
+        picked = set(primary_columns or [])
+
+        joins = []
+        for count, source in enumerate(self.supporting, start=1):
+            alias = f"s{count}"
+            columns = source.get('select_columns')
+            if columns:
+                wanted = [
+                    column for column in columns
+                    if column not in picked and (
+                        column in needed if needed is not None else column != source['merging_on']
+                    )
+                ]
+                select += [f"{alias}.{column} AS {column}" for column in wanted]
+                picked.update(wanted)
+            else:
+                select.append(f"{alias}.*")
+            condition, params = where_sql(source.get('where'), lambda column, alias=alias: f"{alias}.{column}")
+            joins.append(
+                f"LEFT JOIN {source['table_key']} {alias} "
+                f"ON {alias}.{source['merging_on']} = p.{self.primary['merging_on']}"
+                + (f" AND {condition}" if condition else '')
+            )
+            self.query_params += params
+
+        return f"SELECT {', '.join(select)} FROM {self.primary['table_key']} p {' '.join(joins)}"
+
+    def select(self, columns):
+        """Read only the given columns (and the filter and watermark columns) of a single table plan."""
+        extra = [*self.filter_columns, *([self.watermark_column] if self.watermark_column else [])]
+        selected = list(dict.fromkeys(columns + extra))
+        self.primary['query'] = self.query = f"SELECT {', '.join(selected)} FROM {self.primary['table_key']}"
+
+    def project(self, columns):
+        """Sync only the given source columns of a single table plan without a column_mapping."""
+        self.bind(columns)
+        self.select(columns)
+
+    def resolve_projection(self):
+        """
+            Find the source columns the target model has, for a single table plan without
+            select_columns and column_mapping, so the query doesn't read the other columns.
+        """
+
+        if self.getter is not None or self.supporting:
+            return
+        columns = []
+        for rows in stream_db_data(
+            COLUMNS_QUERY, data_value=(self.primary['db_name'].rstrip('.'), self.primary['table_name']),
+            is_dict=False, server=self.server
+        ):
+            columns += [row[0] for row in rows]
+        columns = [column for column in columns if column in self.model_columns]
+        if columns:
+            self.project(columns)
+
+    def bind_record(self, record):
+        """Bind the row layout from a source record, the columns the target model doesn't have are left out."""
+        self.bind([column for column in record if column in self.model_columns])
+
+    def bind(self, source_columns):
+        """Precompute the row layout: which source values go to which target columns."""
+        mapping = self.column_mapping or {column: column for column in source_columns}
+        if self.key_column not in mapping:
+            raise ValueError(f"key column {self.key_column} is not in the column mapping")
+
+        self.source_columns = tuple(mapping)
+        self.target_columns = tuple(mapping[column] for column in self.source_columns)
+        self.key_index = self.source_columns.index(self.key_column)
+        self.target_key = mapping[self.key_column]
+        if len(self.source_columns) == 1:
+            column = self.source_columns[0]
+            self.getter = lambda record: (record.get(column),)
+        else:
+            self.getter = itemgetter(*self.source_columns)
+
+    def to_rows(self, records):
+        """Turn source dictionaries into target ordered tuples, deduplicated on the key and filtered."""
+        if self.getter is None:
+            # select * without a column_mapping, the layout is known from the first row
+            self.bind_record(records[0])
+        if self.filter:
+            records = [record for record in records if self.filter(record)]
+
+        rows = {}
+        key_index = self.key_index
+        for row in map(self.getter, records):
+            if row[key_index] is not None:
+                rows[row[key_index]] = row
+        return list(rows.values())
+
+
+def fanout_plans(definition):
+    """
+        Compile a definition with "targets" into one plan per target.
+
+        Every plan gets a shared reader plan which selects the source columns all the targets
+        need, the reader only reads, its target_table is the definition name for the metrics.
+    """
+
+    base = {key: value for key, value in definition.items() if key != 'targets'}
+    if int(base.get('shards') or 1) > 1 or base.get('checkpoint'):
+        raise ValueError("shards and checkpoint can't be used with targets")
+
+    plans = []
+    for target in definition['targets']:
+        child = dict(base, **target)
+        child['name'] = target.get('name') or f"{definition['name']}.{target['model']}"
+        child['fanout'] = definition['name']
+        child['group'] = definition.get('group', definition['name'])
+        plans.append(SyncPlan(child))
+    if len({plan.target_table for plan in plans}) != len(plans):
+        raise ValueError("two targets write the same table")
+
+    # the source columns every target reads (and filters on), a target without a column_mapping
+    # reads the columns of its model
+    columns = list(dict.fromkeys(
+        column for plan in plans
+        for column in [*(plan.column_mapping or plan.model_columns), *plan.filter_columns]
+    ))
+    selected = {column for source in base['sources'] for column in (source.get('select_columns') or [])}
+    if all(plan.column_mapping for plan in plans):
+        mapping = {column: column for column in columns}
+    elif all(source.get('select_columns') for source in base['sources']):
+        # the model columns of a target without a column_mapping which are not selected aren't read
+        mapping = {column: column for column in columns if column in selected}
+    else:
+        # the columns of the source tables are looked up when the reader is first used
+        mapping = None
+    reader = SyncPlan(dict(base, model=plans[0].model, key_column=plans[0].key_column, column_mapping=mapping))
+    reader.target_table = definition['name']
+    reader.model_columns = columns
+    if mapping and not reader.supporting:
+        reader.select(list(mapping))
+    for plan in plans:
+        plan.reader = reader
+    return plans
+
+
+plan_cache = {}
+plan_cache_lock = threading.Lock()
+
+
+def load_plans(path=SYNC_PLANS_FILE):
+    """
+        Compile the plans of the sync definition file, the compiled plans are reused until the file changes.
+
+        Returns:
+        tuple: (plans, broken) where plans is a list of SyncPlan and broken a list of
+        (definition, error message) for the plans which can't be compiled.
+    """
+
+    mtime = os.path.getmtime(path)
+    with plan_cache_lock:
+        cached = plan_cache.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1], cached[2]
+
+        with open(path) as plan_file:
+            definitions = json.load(plan_file)['plans']
+
+        plans = []
+        broken = []
+        for definition in definitions:
+            if definition.get('enabled') is False:
+                continue
+            try:
+                if definition.get('targets'):
+                    plans += fanout_plans(definition)
+                else:
+                    plans.append(SyncPlan(definition))
+            except Exception as e:
+                logs(f"Sync plan {definition.get('name')} is not valid: {str(e)}", type="error")
+                broken.append((definition, str(e)))
+
+        plan_cache[path] = (mtime, plans, broken)
+        return plans, broken
+
+
+def plan_tables(group):
+    """Return the target tables written by the plans of a group."""
+    plans, _ = load_plans()
+    return [plan.target_table for plan in plans if plan.group == group]
+
+
+def in_clause(column, values):
+    return f" WHERE {column} IN ({', '.join(['%s'] * len(values))})", tuple(values)
+
+
+def build_joins(plan, merging_values=None, read=None):
+    """
+        Read every supporting table of a plan which is not pushed down into a hash join on its merging_on column.
+
+        Parameters:
+        - plan (SyncPlan): The compiled plan.
+        - merging_values (list, optional): Read only the supporting rows which join these values.
+        - read (function, optional): Reads a query like stream_db_data(query, data_value=, server=),
+          stream_db_data by default (the benchmarks read synthetic tables with it).
+    """
+    joins = []
+    picked = set(plan.primary.get('select_columns') or [])
+    needed = set(plan.column_mapping or []) | set(plan.filter_columns)
+    for source in plan.supporting:
+        # a column already read from an earlier table keeps its first value
+        columns = [
+            column for column in source['select_columns']
+            if column not in picked and (column != source['merging_on'] or column in needed)
+        ]
+        picked.update(columns)
+
+        join = HashJoin(plan.primary['merging_on'], source['merging_on'], columns)
+        # a snapshot is the whole table, a read of some merging values doesn't use it
+        settings = snapshot_settings(source) if not merging_values else None
+        if settings is not None:
+            start = time.perf_counter()
+            key = snapshot_key(source, columns)
+            signal = change_signal(source, settings)
+            observe(plan.target_table, 'extract', time.perf_counter() - start, round_trips=1)
+            join.table = get_snapshot(key, signal)
+            if join.table is not None:
+                logs(f"{source['table_name']} is unchanged, its snapshot of {len(join.table)} rows is reused")
+                joins.append(join)
+                continue
+            join.table = {}
+
+        where, params = in_clause(source['merging_on'], merging_values) if merging_values else ('', ())
+        where, params = add_condition(where, params, source['condition'])
+        start = time.perf_counter()
+        extract = TimedBatches(
+            (read or stream_db_data)(source['query'] + where, data_value=params, server=source.get('server', 'legacy')),
+            plan.target_table, 'extract', fetched=True
+        )
+        join.build(extract)
+        # building the hash table is part of the merge, reading the supporting table is extract
+        observe(plan.target_table, 'merge', time.perf_counter() - start - extract.seconds, rows_out=len(join.table))
+        if not join.table and not join.spill_dir:
+            # the joined columns stay empty for every row
+            logs(f"No data fetched from {source['table_name']}.", type="warning")
+        if settings is not None and not join.spill_dir:
+            save_snapshot(key, signal, join.table, settings)
+        joins.append(join)
+    return joins
+
+
+def load_batch(plan, rows, errors, job, lease=None):
+    """Write a batch of changed rows with the load strategy of the plan, the rows are counted for the run total."""
+    try:
+        if plan.load_strategy == 'copy':
+            inserted, updated = merge_rows(
+                rows, plan.target_table, plan.target_columns, plan.target_key, lease,
+                insert_defaults(plan.model, plan.target_columns)
+            )
+        else:
+            inserted, updated = orm_merge_rows(rows, plan.model, list(plan.target_columns), plan.target_key, lease)
+        job.add(rows_written=inserted + updated)
+        row_counts.add(plan.target_table, 'inserted', inserted)
+        row_counts.add(plan.target_table, 'updated', updated)
+        logs(f"Database sync complete for {plan.target_table}: {inserted} inserted, {updated} updated.")
+        return True
+    except Exception as e:
+        errors.append(f"Error syncing data from {plan.primary['table_name']}: {str(e)}")
+        logs(f"Error syncing data from {plan.primary['table_name']}: {str(e)}", type="error")
+        return False
+
+
+def read_batches(plan, source_batches, read=None):
+    """Measure the batches read from the first source table and join the supporting tables (read with read) into them."""
+    extract = TimedBatches(source_batches, plan.target_table, 'extract', fetched=True)
+    batches = extract
+
+    # without pushdown the supporting tables are read once and every batch of the first table
+    # is joined through them as it is streamed
+    if plan.supporting and not plan.pushdown:
+        for join in build_joins(plan, read=read):
+            batches = join.stream(batches)
+        batches = TimedBatches(batches, plan.target_table, 'merge', inner=extract)
+    return batches
+
+
+def sync_batch(plan, records, errors, job, lease):
+    """
+        Dedupe one batch of source records, drop the unchanged rows and load the rest.
+
+        Returns:
+        tuple: (committed, rows) where rows are the deduplicated target rows of the batch.
+    """
+
+    target_table = plan.target_table
+    lease.check()
+    with Phase(target_table, 'dedupe', rows_in=len(records)) as measured:
+        rows = plan.to_rows(records)
+        measured.rows_out = len(rows)
+    if not rows:
+        if not plan.filter:
+            logs("No unique record IDs found in the fetched data.", type="warning")
+        return True, rows
+
+    # rows unchanged since their last commit are not sent to the target
+    changed_rows, fingerprints = rows, None
+    if plan.fingerprint_cache:
+        with Phase(target_table, 'diff', rows_in=len(rows), round_trips=1) as measured:
+            changed_rows, fingerprints = filter_changed(
+                target_table, rows, plan.key_index, plan.target_columns
+            )
+            measured.rows_out = len(changed_rows)
+
+    job.add(rows_diffed=len(rows))
+    job.set_phase(target_table, 'load')
+
+    batch_synced = True
+    if changed_rows:
+        batch_synced = load_batch(plan, changed_rows, errors, job, lease)
+    if batch_synced:
+        with Phase(target_table, 'diff', round_trips=1 if fingerprints else 0):
+            save_fingerprints(fingerprints)
+    job.set_phase(target_table, 'extract')
+    return batch_synced, rows
+
+
+def sync_rows(plan, errors, job, lease, shard=None):
+    """
+        Stream the rows of a plan (or of one shard of it), drop the unchanged ones and load the rest.
+
+        Returns:
+        bool: True when every batch is committed.
+    """
+
+    target_table = plan.target_table
+    watermark_key = plan.primary['table_key'] + (shard.suffix if shard else '')
+    checkpoint_name = target_table + (shard.suffix if shard else '')
+    plan.resolve_projection()
+    where, params = watermark_clause(watermark_key, plan.watermark_sql)
+    where, params = add_condition(where, params, plan.condition)
+    key_sql = f"p.{plan.key_column}" if plan.pushdown else plan.key_column
+    if shard:
+        condition = shard.condition(key_sql)
+        where = f"{where} AND {condition}" if where else f" WHERE {condition}"
+
+    # an unfinished run leaves its checkpoint, the rows up to it are committed already
+    checkpoint = get_checkpoint(checkpoint_name) if plan.checkpoint else None
+    if checkpoint:
+        logs(f"{checkpoint_name} continues run {checkpoint['run_id']} from its checkpoint")
+
+    ranges = None
+    if plan.readers > 1:
+        if checkpoint:
+            ranges = pending_ranges(checkpoint)
+        else:
+            ranges = key_ranges(plan, key_sql, where, params, plan.readers * RANGES_PER_READER)
+    if plan.checkpoint and not checkpoint:
+        checkpoint = start_checkpoint(checkpoint_name, ranges)
+
+    if ranges is not None:
+        source_batches = parallel_stream(plan, key_sql, where, params, plan.readers, ranges, ordered=plan.checkpoint)
+    else:
+        query = plan.query
+        if checkpoint and checkpoint['last_key'] is not None:
+            condition = f"{key_sql} > %s"
+            where = f"{where} AND {condition}" if where else f" WHERE {condition}"
+            params = tuple(params) + (checkpoint['last_key'],)
+        if checkpoint:
+            where += f" ORDER BY {key_sql}"
+        source_batches = stream_db_data(query + where, data_value=plan.query_params + params, server=plan.server)
+    batches = read_batches(plan, source_batches)
+
+    # the table is read and written batch by batch so memory stays bounded by the batch size
+    fetched = False
+    synced = True
+    new_watermark = checkpoint['watermark'] if checkpoint else None
+    for records in batches:
+        fetched = True
+        job.add(rows_extracted=len(records))
+        batch_synced, rows = sync_batch(plan, records, errors, job, lease)
+        if not rows:
+            continue
+
+        if batch_synced:
+            if plan.watermark_column:
+                new_watermark = max_watermark(records, plan.watermark_column, new_watermark)
+            if checkpoint:
+                checkpoint['watermark'] = new_watermark
+                save_checkpoint(checkpoint_name, advance_checkpoint(checkpoint, rows[-1][plan.key_index]))
+        else:
+            synced = False
+            if checkpoint:
+                # the keys after a failed batch are not committed, the next run continues from the checkpoint
+                break
+
+    if not fetched:
+        logs(f"No data fetched from {plan.primary['table_name']}{shard.suffix if shard else ''}.", type="warning")
+
+    # move the watermark only when every batch is committed
+    if synced and new_watermark is not None:
+        set_watermark(watermark_key, new_watermark)
+    if synced and checkpoint:
+        clear_checkpoint(checkpoint_name)
+    return synced
+
+
+def sync_plan(plan, errors, job):
+    """
+        Sync one plan: stream the first source table batch by batch, join the supporting tables,
+        drop the unchanged rows and load the rest into the target.
+
+        The table (or every shard of it) is synced under a redis lease, so no other worker
+        syncs it at the same time.
+
+        Parameters:
+        - plan (SyncPlan): The compiled plan.
+        - errors (list): The sync errors are appended to it.
+        - job (SyncJob): The job which tracks the progress.
+    """
+
+    target_table = plan.target_table
+    started = time.perf_counter()
+    try:
+        logs(f"{plan.name} syncing is starting")
+        if not claim_table(job, target_table):
+            errors.append(f"{target_table} is already syncing in another job")
+            return
+        job.set_phase(target_table, 'extract')
+
+        synced = True
+        ran = False
+        for shard in plan_shards(plan, f"p.{plan.key_column}" if plan.pushdown else plan.key_column):
+            lease = acquire(shard.lease_name if shard else target_table)
+            if lease is None:
+                # another replica runs the same schedule, it syncs the table (or shard) now
+                logs(f"{shard.lease_name if shard else target_table} is syncing on another worker, it is skipped")
+                continue
+            try:
+                if shard and shard.is_done():
+                    continue
+                ran = True
+                shard_synced = sync_rows(plan, errors, job, lease, shard)
+                if shard and shard_synced:
+                    shard.mark_done()
+                synced = synced and shard_synced
+            finally:
+                lease.release()
+
+        job.set_phase(target_table, ('done' if ran else 'skipped') if synced else 'failed')
+
+    except Exception as e:
+        logs(f"Error syncing {plan.name}: {str(e)}", type="error")
+        errors.append(f"Error syncing {plan.name}: {str(e)}")
+        job.set_phase(target_table, 'failed')
+    finally:
+        release_table(job, target_table)
+        row_counts.flush(target_table)
+        observe_run(job, target_table, time.perf_counter() - started)
+
+
+def sync_fanout(plans, errors, job):
+    """
+        Sync the targets of a definition with "targets" from one read of its sources: every batch
+        is filtered, projected and loaded into each target in turn.
+
+        A target which fails or can't be claimed doesn't stop the others, the watermark of the
+        sources moves only when every target committed every batch.
+
+        Parameters:
+        - plans (list): The SyncPlan of every target, they share one reader plan.
+        - errors (list): The sync errors are appended to it.
+        - job (SyncJob): The job which tracks the progress.
+    """
+
+    reader = plans[0].reader
+    started = time.perf_counter()
+    claimed = []
+    leases = {}
+    synced = {}
+    try:
+        logs(f"{reader.name} syncing is starting for {[plan.target_table for plan in plans]}")
+        for plan in plans:
+            if not claim_table(job, plan.target_table):
+                errors.append(f"{plan.target_table} is already syncing in another job")
+                continue
+            claimed.append(plan)
+            lease = acquire(plan.target_table)
+            if lease is None:
+                logs(f"{plan.target_table} is syncing on another worker, it is skipped")
+                job.set_phase(plan.target_table, 'skipped')
+                continue
+            leases[plan.target_table] = lease
+            synced[plan.target_table] = True
+            job.set_phase(plan.target_table, 'extract')
+
+        active = [plan for plan in claimed if plan.target_table in leases]
+        if not active:
+            return
+
+        for plan in [reader, *active]:
+            plan.resolve_projection()
+        where, params = watermark_clause(reader.primary['table_key'], reader.watermark_sql)
+        where, params = add_condition(where, params, reader.condition)
+        key_sql = f"p.{reader.key_column}" if reader.pushdown else reader.key_column
+        ranges = None
+        if reader.readers > 1:
+            ranges = key_ranges(reader, key_sql, where, params, reader.readers * RANGES_PER_READER)
+        if ranges is not None:
+            source_batches = parallel_stream(reader, key_sql, where, params, reader.readers, ranges)
+        else:
+            source_batches = stream_db_data(
+                reader.query + where, data_value=reader.query_params + params, server=reader.server
+            )
+
+        fetched = False
+        new_watermark = None
+        for records in read_batches(reader, source_batches):
+            fetched = True
+            job.add(rows_extracted=len(records))
+            for plan in list(active):
+                try:
+                    batch_synced, _ = sync_batch(plan, records, errors, job, leases[plan.target_table])
+                except Exception as e:
+                    # only this target stops, the others keep reading the batches
+                    errors.append(f"Error syncing {plan.name}: {str(e)}")
+                    logs(f"Error syncing {plan.name}: {str(e)}", type="error")
+                    active.remove(plan)
+                    job.set_phase(plan.target_table, 'failed')
+                    batch_synced = False
+                synced[plan.target_table] = synced[plan.target_table] and batch_synced
+            if not active:
+                break
+            if reader.watermark_column:
+                new_watermark = max_watermark(records, reader.watermark_column, new_watermark)
+
+        if not fetched:
+            logs(f"No data fetched from {reader.primary['table_name']}.", type="warning")
+        # move the watermark only when every target committed every batch
+        if new_watermark is not None and len(synced) == len(plans) and all(synced.values()):
+            set_watermark(reader.primary['table_key'], new_watermark)
+        for plan in active:
+            job.set_phase(plan.target_table, 'done' if synced[plan.target_table] else 'failed')
+
+    except Exception as e:
+        logs(f"Error syncing {reader.name}: {str(e)}", type="error")
+        errors.append(f"Error syncing {reader.name}: {str(e)}")
+        for plan in claimed:
+            job.set_phase(plan.target_table, 'failed')
+    finally:
+        for lease in leases.values():
+            lease.release()
+        elapsed = time.perf_counter() - started
+        for plan in claimed:
+            if job.tables.get(plan.target_table) not in ('done', 'failed', 'skipped'):
+                job.set_phase(plan.target_table, 'failed')
+            release_table(job, plan.target_table)
+            row_counts.flush(plan.target_table)
+            observe_run(job, plan.target_table, elapsed)
+
+
+def select_plans(group, name=None):
+    """
+        Find the plans of a group, or the plan (or definition with targets) with a name.
+
+        Returns:
+        tuple: (errors, plans, fanouts) where errors are the messages of the broken definitions,
+        plans the plans synced on their own and fanouts {definition name: [plan of every target]}.
+    """
+
+    plans, broken = load_plans()
+    if name:
+        selected = lambda definition: definition.get('name') == name
+    else:
+        selected = lambda definition: definition.get('group', definition.get('name')) == group
+
+    errors = [
+        f"Sync plan {definition.get('name')} is not valid: {error}"
+        for definition, error in broken if selected(definition)
+    ]
+
+    single = []
+    fanouts = {}
+    for plan in plans:
+        if not (selected({'name': plan.name, 'group': plan.group}) or (name and plan.fanout == name)):
+            continue
+        if plan.fanout:
+            # the targets of one definition share a single read of the sources
+            fanouts.setdefault(plan.fanout, []).append(plan)
+        else:
+            single.append(plan)
+    return errors, single, fanouts
+
+
+def run_plans(group, job=None, name=None):
+    """
+        Sync every plan of a group in parallel.
+
+        Parameters:
+        - group (str): The plan group (sync-tables, selective-column-sync-tables, combine-table-and-sync).
+        - job (SyncJob, optional): The job which tracks the progress.
+        - name (str, optional): Sync only the plan with this name instead of a group.
+
+        Returns:
+        bool: True if no errors were encountered.
+    """
+
+    job = job or SyncJob(name or group)
+    errors, plans, fanouts = select_plans(group, name)
+    jobs = [
+        {"name": plan.name, "sources": plan.db_names, "run": partial(sync_plan, plan, job=job)} for plan in plans
+    ]
+    for fanout, targets in fanouts.items():
+        jobs.append({"name": fanout, "sources": targets[0].db_names, "run": partial(sync_fanout, targets, job=job)})
+
+    # the tables are synced in parallel, the errors of every job are collected together
+    errors += run_jobs(jobs)
+    job.add_errors(errors)
+
+    # Log all accumulated errors after processing all tables
+    if errors:
+        logs("Errors encountered during sync process:", type="error")
+        for error in errors:
+            logs(error, type="error")
+
+    return not errors  # Return True if no errors were encountered
+
+
+# Example usage: python -m scripts.sync_engine combine-table-and-sync
+if __name__ == "__main__":
+    run_plans(sys.argv[1])
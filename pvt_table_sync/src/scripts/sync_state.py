@@ -0,0 +1,254 @@
+import hashlib
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from uuid import uuid4
+from utils import r11
+
+
+"""
+    this module keeps the small pieces of state the sync scripts need between runs in redis.
+    * watermark is the highest value of the incremental column which is already synced for a table
+    * fingerprint is a short hash of the synced columns of every row, rows with the same hash
+      as the last committed one are not sent to the target again
+    * cdc position is the binlog file and position which are already applied for a mysql server
+    * checkpoint is the last committed key of a run which is not finished yet, the next run
+      continues after it (per key range when the table is read by several readers),
+      dates and decimals in it are saved with their type so a resumed run compares them
+      with the values it reads
+"""
+
+WATERMARK_KEY = 'table_sync:watermark:{}'
+FINGERPRINT_KEY = 'table_sync:fingerprint:{}:{}'
+CDC_POSITION_KEY = 'table_sync:cdc_position:{}'
+CHECKPOINT_KEY = 'table_sync:checkpoint:{}'
+
+
+def get_watermark(table_key):
+    """
+        Get the saved high-water mark of a table.
+
+        Parameters:
+        - table_key (str): The source table with its db prefix (e.g. db_ems.user_meter_detail).
+
+        Returns:
+        str | None: The last synced value of the incremental column, None on the first run.
+    """
+
+    value = r11.get(WATERMARK_KEY.format(table_key))
+    return value.decode() if value is not None else None
+
+
+def set_watermark(table_key, value):
+    """
+        Save the high-water mark of a table. Call it only after the data is committed.
+
+        Parameters:
+        - table_key (str): The source table with its db prefix.
+        - value: The highest value of the incremental column in the committed rows.
+    """
+
+    if value is None:
+        return
+    r11.set(WATERMARK_KEY.format(table_key), str(value))
+
+
+def reset_watermark(table_key):
+    """Forget the high-water mark so the next run reads the full table again."""
+    r11.delete(WATERMARK_KEY.format(table_key))
+
+
+def watermark_clause(table_key, column):
+    """
+        Build the WHERE clause which reads only the rows past the saved high-water mark.
+
+        Rows equal to the mark are read again, so rows written in the same second
+        (or with the same value) as the last synced row are never missed; re-reading
+        them is harmless because unchanged rows are not written.
+
+        Parameters:
+        - table_key (str): The source table with its db prefix.
+        - column (str): The incremental column (updated_at / timestamp / auto increment id).
+
+        Returns:
+        tuple: (sql, params) to append to the SELECT query, ('', ()) for a full read.
+    """
+
+    if not column:
+        return '', ()
+
+    mark = get_watermark(table_key)
+    if mark is None:
+        return '', ()
+    return f" WHERE {column} >= %s", (mark,)
+
+
+def max_watermark(records, column, current=None):
+    """Return the highest value of the incremental column in records (or current if higher)."""
+    values = [record[column] for record in records if record.get(column) is not None]
+    if isinstance(current, str) and values and not isinstance(values[0], str):
+        # a checkpoint saved before the values kept their type has the value as text
+        kind = type(values[0])
+        current = kind.fromisoformat(current) if hasattr(kind, 'fromisoformat') else kind(current)
+    if current is not None:
+        values.append(current)
+    return max(values) if values else None
+
+
+def fingerprint(values):
+    """Return an 8 byte hash of a tuple of column values."""
+    return hashlib.blake2b(repr(values).encode(), digest_size=8).digest()
+
+
+def fingerprint_key(target_table, columns):
+    # the column list is part of the key, so changing a column_mapping starts a new store
+    signature = hashlib.blake2b(repr(tuple(columns)).encode(), digest_size=4).hexdigest()
+    return FINGERPRINT_KEY.format(target_table, signature)
+
+
+def filter_changed(target_table, rows, key_index, columns):
+    """
+        Drop the rows which are unchanged since they were last committed.
+
+        Parameters:
+        - target_table (str): The target table name, the store is kept per target table.
+        - rows (list): Row tuples in the order of columns.
+        - key_index (int): The position of the key in a row.
+        - columns (list): The target column names of the rows.
+
+        Returns:
+        tuple: (changed rows, fingerprints), pass the fingerprints to save_fingerprints
+        once the changed rows are committed.
+    """
+
+    if not rows:
+        return rows, None
+
+    store = fingerprint_key(target_table, columns)
+    keys = [str(row[key_index]) for row in rows]
+    changed, fingerprints = compare_fingerprints(rows, keys, r11.hmget(store, keys))
+    return changed, (store, fingerprints)
+
+
+def compare_fingerprints(rows, keys, saved):
+    """Return the rows whose fingerprint differs from the saved one and their new fingerprints by key."""
+    changed = []
+    fingerprints = {}
+    for row, key, old_value in zip(rows, keys, saved):
+        value = fingerprint(row)
+        if value != old_value:
+            changed.append(row)
+            fingerprints[key] = value
+    return changed, fingerprints
+
+
+def save_fingerprints(fingerprints):
+    """Save the fingerprints returned by filter_changed after the rows are committed."""
+    if not fingerprints or not fingerprints[1]:
+        return
+    store, values = fingerprints
+    r11.hset(store, mapping=values)
+
+
+def reset_fingerprints(target_table):
+    """Forget every fingerprint of a target table so the next run compares all rows with the target."""
+    for store in r11.scan_iter(FINGERPRINT_KEY.format(target_table, '*')):
+        r11.delete(store)
+
+
+def forget_fingerprints(target_table, columns, keys):
+    """Remove the fingerprints of deleted rows, so the rows are written again if they come back."""
+    if keys:
+        r11.hdel(fingerprint_key(target_table, columns), *[str(key) for key in keys])
+
+
+def get_cdc_position(server):
+    """Return the applied binlog position of a server as {'log_file': ..., 'log_pos': ...} or None."""
+    value = r11.get(CDC_POSITION_KEY.format(server))
+    return json.loads(value) if value is not None else None
+
+
+def set_cdc_position(server, log_file, log_pos):
+    """Save the binlog position of a server. Call it only after the events before it are committed."""
+    r11.set(CDC_POSITION_KEY.format(server), json.dumps({'log_file': log_file, 'log_pos': log_pos}))
+
+
+def start_checkpoint(name, ranges=None):
+    """
+        Start the checkpoint of a new run.
+
+        Parameters:
+        - name (str): The target table, with the shard suffix for a sharded plan.
+        - ranges (list, optional): The [lo, hi) key ranges of a table read by several readers.
+
+        Returns:
+        dict: The checkpoint, pass it to save_checkpoint after every committed batch.
+    """
+
+    checkpoint = {
+        'run_id': uuid4().hex,
+        'started_at': datetime.now().isoformat(),
+        'last_key': None,
+        # the highest watermark value of the committed batches, the watermark moves when the run ends
+        'watermark': None,
+        'ranges': [[lo, hi, None] for lo, hi in ranges] if ranges else None
+    }
+    save_checkpoint(name, checkpoint)
+    return checkpoint
+
+
+def encode_value(value):
+    # datetime first, a datetime is a date too
+    for kind in (datetime, date):
+        if isinstance(value, kind):
+            return {'__type__': kind.__name__, 'value': value.isoformat()}
+    if isinstance(value, Decimal):
+        return {'__type__': 'decimal', 'value': str(value)}
+    return str(value)
+
+
+def decode_value(value):
+    kind = value.get('__type__')
+    if kind == 'datetime':
+        return datetime.fromisoformat(value['value'])
+    if kind == 'date':
+        return date.fromisoformat(value['value'])
+    if kind == 'decimal':
+        return Decimal(value['value'])
+    return value
+
+
+def get_checkpoint(name):
+    """Return the checkpoint of an unfinished run or None."""
+    value = r11.get(CHECKPOINT_KEY.format(name))
+    return json.loads(value, object_hook=decode_value) if value is not None else None
+
+
+def save_checkpoint(name, checkpoint):
+    r11.set(CHECKPOINT_KEY.format(name), json.dumps(checkpoint, default=encode_value))
+
+
+def clear_checkpoint(name):
+    """Forget the checkpoint once the run is finished."""
+    r11.delete(CHECKPOINT_KEY.format(name))
+
+
+def advance_checkpoint(checkpoint, last):
+    """Move the checkpoint (or the key range of last) to the last committed key of an ordered read."""
+    if checkpoint['ranges'] is None:
+        checkpoint['last_key'] = last
+        return checkpoint
+    for key_range in checkpoint['ranges']:
+        if key_range[0] <= last < key_range[1]:
+            key_range[2] = last
+    return checkpoint
+
+
+def pending_ranges(checkpoint):
+    """Return the [lo, hi) key ranges which are still to read, None for a single reader checkpoint."""
+    if checkpoint['ranges'] is None:
+        return None
+    return [
+        (lo if last is None else last + 1, hi)
+        for lo, hi, last in checkpoint['ranges'] if last is None or last + 1 < hi
+    ]
@@ -0,0 +1,414 @@
+import os
+import sys
+from sqlalchemy import Integer, Numeric, DateTime, Date
+from config import psql_connection, stream_db_data
+from utils import logs, row_counts
+from scripts.jobs import SyncJob
+from scripts.leases import acquire
+from scripts.loader import quote, delete_rows
+from scripts.predicates import add_condition
+from scripts.sync_engine import load_plans, load_batch
+from scripts.sync_state import forget_fingerprints
+
+
+"""
+    this code checks that a target table matches its source without reading either table in full
+    (in the style of pt-table-checksum)
+    * the key space is split into chunks, every chunk gets a row count and a checksum which both
+      databases compute themselves: the sum of a 32 bit md5 prefix of every row
+    * the values are written as the same text on both sides before they are hashed,
+      e.g. floats with 6 decimals and datetimes as YYYY-MM-DD HH:MM:SS
+    * only the chunks which differ are split again, a chunk with few rows is repaired:
+      its source rows are written through the load strategy of the plan and the target rows
+      which are not in the source are deleted
+    * integer keys are split into equal key ranges, other keys into key ranges between boundary keys
+      sampled from the side with more rows, so every chunk is a range of the key index
+    * keys are compared under the collation of their column, so the index of the key reads every chunk,
+      a chunk whose sampled boundaries don't shrink it (e.g. one repeated key) is not split again
+    * two databases may order text keys differently, a key can then fall into different chunks
+      on the two sides: its chunks differ and are written again, but a target key is deleted
+      only after it was looked up in the source
+    * the where and filter of the plan limit the source side, target rows which don't pass
+      them any more are deleted by a repair
+    * a repair holds the lease of the target table like a sync and writes with its fencing token,
+      so it never commits over a sync of the table on another worker
+    the cost grows with the number of differing chunks, only their rows leave the databases
+"""
+
+# number of sub chunks a differing chunk is split into
+SYNC_VERIFY_FANOUT = int(os.environ.get('SYNC_VERIFY_FANOUT', 16))
+# a differing chunk with at most this many rows is repaired instead of split
+SYNC_VERIFY_LEAF_ROWS = int(os.environ.get('SYNC_VERIFY_LEAF_ROWS', 1000))
+
+NULL_TEXT = "'<null>'"
+
+
+def column_text(dialect, column, column_type):
+    """SQL which writes a column as the same text in mysql and postgres."""
+    if dialect == 'mysql':
+        column = f"`{column}`"
+        if isinstance(column_type, Integer):
+            value = f"CAST(CAST({column} AS SIGNED) AS CHAR)"
+        elif isinstance(column_type, Numeric):
+            value = f"CAST(CAST({column} AS DECIMAL(30,6)) AS CHAR)"
+        elif isinstance(column_type, DateTime):
+            value = f"CAST(CAST({column} AS DATETIME) AS CHAR)"
+        elif isinstance(column_type, Date):
+            value = f"CAST(CAST({column} AS DATE) AS CHAR)"
+        else:
+            value = f"CAST({column} AS CHAR)"
+    else:
+        column = quote(column)
+        if isinstance(column_type, Integer):
+            value = f"CAST({column} AS BIGINT)::text"
+        elif isinstance(column_type, Numeric):
+            value = f"CAST({column} AS NUMERIC(30,6))::text"
+        elif isinstance(column_type, DateTime):
+            value = f"to_char({column}, 'YYYY-MM-DD HH24:MI:SS')"
+        elif isinstance(column_type, Date):
+            value = f"to_char({column}, 'YYYY-MM-DD')"
+        else:
+            value = f"{column}::text"
+    return f"COALESCE({value}, {NULL_TEXT})"
+
+
+def hash32(dialect, text):
+    """SQL for an unsigned 32 bit hash of a text, the same value in both databases."""
+    if dialect == 'mysql':
+        return f"CAST(CONV(SUBSTRING(MD5({text}), 1, 8), 16, 10) AS UNSIGNED)"
+    return f"('x' || substr(md5({text}), 1, 8))::bit(32)::bigint"
+
+
+class Side:
+    """The source or the target table of a plan, with the SQL to checksum it."""
+
+    def __init__(self, plan, dialect):
+        self.plan = plan
+        self.dialect = dialect
+        types = plan.model.__table__.columns
+        if dialect == 'mysql':
+            self.table = plan.primary['table_key']
+            self.key = f"`{plan.key_column}`"
+            self.condition = plan.condition
+            columns = plan.source_columns
+        else:
+            self.table = quote(plan.target_table)
+            self.key = quote(plan.target_key)
+            self.condition = ('', ())
+            columns = plan.target_columns
+        texts = [
+            column_text(dialect, column, types[target].type)
+            for column, target in zip(columns, plan.target_columns)
+        ]
+        self.row_hash = hash32(dialect, f"CONCAT_WS('#', {', '.join(texts)})")
+        self.div = 'DIV' if dialect == 'mysql' else '/'
+
+    def fetch(self, query, params=()):
+        if self.dialect == 'mysql':
+            rows = []
+            for records in stream_db_data(query, data_value=params, is_dict=False, server=self.plan.server):
+                rows += records
+            return rows
+        with psql_connection() as con:
+            cursor = con.cursor()
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            cursor.close()
+            return rows
+
+    def where(self, chunk):
+        where, params = chunk.where(self)
+        return add_condition(where, params, self.condition)
+
+    def key_bounds(self):
+        where, params = add_condition('', (), self.condition)
+        return self.fetch(f"SELECT MIN({self.key}), MAX({self.key}) FROM {self.table}{where}", params)[0]
+
+    def checksums(self, chunk):
+        """
+            Checksum the sub chunks of a split chunk in one query.
+
+            Returns:
+            dict: sub chunk number: (row count, checksum).
+        """
+
+        where, params = self.where(chunk)
+        bucket, bucket_params = chunk.bucket(self)
+        rows = self.fetch(
+            f"SELECT {bucket} AS bucket, COUNT(*), COALESCE(SUM({self.row_hash}), 0) "
+            f"FROM {self.table}{where} GROUP BY 1",
+            bucket_params + params
+        )
+        return {int(bucket): (int(count), int(total)) for bucket, count, total in rows}
+
+    def records(self, chunk):
+        """The source records of a chunk read through the plan query."""
+        where, params = self.where(chunk)
+        plan = self.plan
+        return stream_db_data(plan.query + where, data_value=plan.query_params + params, server=plan.server)
+
+    def keys(self, chunk):
+        where, params = self.where(chunk)
+        return [row[0] for row in self.fetch(f"SELECT {self.key} FROM {self.table}{where}", params)]
+
+    def existing(self, keys):
+        """The given keys which are in the table, looked up by the key index in batches."""
+        found = []
+        for start in range(0, len(keys), SYNC_VERIFY_LEAF_ROWS):
+            batch = tuple(keys[start:start + SYNC_VERIFY_LEAF_ROWS])
+            where, params = add_condition(
+                f" WHERE {self.key} IN ({', '.join(['%s'] * len(batch))})", batch, self.condition
+            )
+            found += [row[0] for row in self.fetch(f"SELECT {self.key} FROM {self.table}{where}", params)]
+        return found
+
+    def boundaries(self, chunk, fanout):
+        """
+            Sample the keys which split the rows of a chunk into fanout ranges of about the same size.
+
+            Returns:
+            list: Up to fanout - 1 keys in key order, the first key of every range but the first one.
+        """
+
+        where, params = self.where(chunk)
+        rows = self.fetch(
+            f"SELECT k FROM (SELECT {self.key} AS k, ROW_NUMBER() OVER (ORDER BY {self.key}) AS n, "
+            f"COUNT(*) OVER () AS c FROM {self.table}{where}) s "
+            f"WHERE n > 1 AND MOD((n - 1) * %s, c) < %s ORDER BY n",
+            params + (fanout, fanout)
+        )
+        return [row[0] for row in rows]
+
+
+class KeyRange:
+    """Integer keys lo <= key < hi."""
+
+    def __init__(self, lo, hi):
+        self.lo = lo
+        self.hi = hi
+        self.width = None
+
+    def split(self, source, target, fanout):
+        # the sub ranges have the same width, the keys are not read for it
+        self.width = max(1, -(-(self.hi - self.lo) // fanout))
+
+    def where(self, side):
+        return f" WHERE {side.key} >= %s AND {side.key} < %s", (self.lo, self.hi)
+
+    def bucket(self, side):
+        return f"({side.key} - %s) {side.div} %s", (self.lo, self.width)
+
+    def child(self, bucket, sample=None):
+        lo = self.lo + bucket * self.width
+        return KeyRange(lo, min(self.hi, lo + self.width))
+
+    def splittable(self):
+        return self.hi - self.lo > 1
+
+    def __repr__(self):
+        return f"[{self.lo}, {self.hi})"
+
+
+class BoundaryRange:
+    """
+        Keys lo <= key < hi in the collation of the key column, None is open, split at boundary keys.
+
+        Parameters:
+        - lo, hi: The bounds of the range.
+        - sample (str, optional): The side which has more rows in the range (source, target),
+          the boundaries of its sub ranges are sampled from it.
+        - parent (BoundaryRange, optional): The range it was split from.
+    """
+
+    def __init__(self, lo=None, hi=None, sample='source', parent=None):
+        self.lo = lo
+        self.hi = hi
+        self.sample = sample
+        self.parent = parent
+        self.bounds = None
+
+    def split(self, source, target, fanout):
+        side = source if self.sample == 'source' else target
+        self.bounds = side.boundaries(self, fanout)
+
+    def where(self, side):
+        parts = []
+        params = ()
+        if self.lo is not None:
+            parts.append(f"{side.key} >= %s")
+            params += (self.lo,)
+        if self.hi is not None:
+            parts.append(f"{side.key} < %s")
+            params += (self.hi,)
+        return (f" WHERE {' AND '.join(parts)}" if parts else ''), params
+
+    def bucket(self, side):
+        if not self.bounds:
+            return '0', ()
+        cases = ' '.join(f"WHEN {side.key} < %s THEN {number}" for number in range(len(self.bounds)))
+        return f"CASE {cases} ELSE {len(self.bounds)} END", tuple(self.bounds)
+
+    def child(self, bucket, sample='source'):
+        edges = [self.lo, *self.bounds, self.hi]
+        return BoundaryRange(edges[bucket], edges[bucket + 1], sample, self)
+
+    def splittable(self):
+        # no boundaries or only repeated keys were sampled, splitting it again gives the same range
+        return self.parent is None or (self.lo, self.hi) != (self.parent.lo, self.parent.hi)
+
+    def __repr__(self):
+        return f"[{self.lo!r}, {self.hi!r})"
+
+
+def first_chunk(plan, source, target):
+    """The chunk which covers every key of both tables."""
+    if not isinstance(plan.model.__table__.columns[plan.target_key].type, Integer):
+        return BoundaryRange()
+    bounds = [value for side in (source, target) for value in side.key_bounds() if value is not None]
+    if not bounds:
+        return None
+    return KeyRange(int(min(bounds)), int(max(bounds)) + 1)
+
+
+def repair_chunk(plan, chunk, source, target, errors, job, report, lease):
+    """Write the source rows of a chunk to the target and delete the target rows missing in the source."""
+    rows = []
+    for records in source.records(chunk):
+        rows += plan.to_rows(records)
+    source_keys = {row[plan.key_index] for row in rows}
+    missing = [key for key in target.keys(chunk) if key not in source_keys]
+    if missing:
+        # the source may order the keys differently and keep some of them in another chunk
+        kept = set(source.existing(missing))
+        missing = [key for key in missing if key not in kept]
+
+    if rows and not load_batch(plan, rows, errors, job, lease):
+        return
+    if missing:
+        report['rows_deleted'] += delete_rows(plan.target_table, plan.target_key, missing, lease)
+    # the saved fingerprints don't match the target any more, the next sync compares these rows again
+    forget_fingerprints(plan.target_table, plan.target_columns, list(source_keys) + missing)
+    report['rows_repaired'] += len(rows)
+
+
+def verify_chunk(plan, chunk, source, target, lease, errors, job, report):
+    """Compare the sub chunks of a chunk, the differing ones are repaired under lease (only reported without one)."""
+    chunk.split(source, target, SYNC_VERIFY_FANOUT)
+    source_sums = source.checksums(chunk)
+    target_sums = target.checksums(chunk)
+    report['chunks_checked'] += len(set(source_sums) | set(target_sums))
+
+    for bucket in sorted(set(source_sums) | set(target_sums)):
+        source_sum = source_sums.get(bucket, (0, 0))
+        target_sum = target_sums.get(bucket, (0, 0))
+        if source_sum == target_sum:
+            continue
+
+        rows = max(source_sum[0], target_sum[0])
+        # the boundaries of a sub chunk are sampled from the side with more rows in it
+        sample = 'source' if source_sum[0] >= target_sum[0] else 'target'
+        sub_chunk = chunk.child(bucket, sample)
+        if rows > SYNC_VERIFY_LEAF_ROWS and sub_chunk.splittable():
+            verify_chunk(plan, sub_chunk, source, target, lease, errors, job, report)
+            continue
+
+        report['mismatched_chunks'].append(repr(sub_chunk))
+        logs(
+            f"{plan.target_table} differs in {sub_chunk}: source {source_sum[0]} rows, "
+            f"target {target_sum[0]} rows", type="warning"
+        )
+        if lease:
+            repair_chunk(plan, sub_chunk, source, target, errors, job, report, lease)
+
+
+def verify_plan(plan, repair=True, errors=None, job=None):
+    """
+        Compare the target table of a plan with its source chunk by chunk and repair the differences.
+
+        Parameters:
+        - plan (SyncPlan): A plan with one source table.
+        - repair (bool, optional): Write the differing chunks again, only report them if False.
+        - errors (list, optional): The repair errors are appended to it.
+        - job (SyncJob, optional): The job which tracks the progress.
+
+        Returns:
+        dict: The checked chunk count, the differing chunks and the repaired and deleted row counts.
+    """
+
+    errors = errors if errors is not None else []
+    job = job or SyncJob(f"verify-{plan.name}")
+    if plan.supporting:
+        raise ValueError(f"{plan.name} joins supporting tables, only single table plans can be verified")
+    plan.resolve_projection()
+    if plan.getter is None:
+        # the source columns are not readable from information_schema, the layout is known from a source row
+        for records in stream_db_data(plan.query + " LIMIT 1", server=plan.server):
+            plan.bind_record(records[0])
+
+    report = {'table': plan.target_table, 'chunks_checked': 0, 'mismatched_chunks': [],
+              'rows_repaired': 0, 'rows_deleted': 0}
+    if plan.getter is None:
+        logs(f"No data fetched from {plan.primary['table_name']}.", type="warning")
+        return report
+
+    lease = None
+    if repair:
+        lease = acquire(plan.target_table)
+        if lease is None:
+            errors.append(f"{plan.target_table} is syncing on another worker, it can't be repaired now")
+            logs(f"{plan.target_table} is syncing on another worker, it can't be repaired now", type="error")
+            return report
+    try:
+        source = Side(plan, 'mysql')
+        target = Side(plan, 'postgres')
+        chunk = first_chunk(plan, source, target)
+        if chunk:
+            verify_chunk(plan, chunk, source, target, lease, errors, job, report)
+    finally:
+        if lease:
+            lease.release()
+    row_counts.flush(plan.target_table)
+
+    logs(
+        f"verified {plan.target_table}: {report['chunks_checked']} chunks checked, "
+        f"{len(report['mismatched_chunks'])} differing, {report['rows_repaired']} rows repaired, "
+        f"{report['rows_deleted']} rows deleted"
+    )
+    return report
+
+
+def run_verify(name, repair=True, job=None):
+    """
+        Verify the target table of a plan.
+
+        Parameters:
+        - name (str): The plan name in sync_plans.json.
+        - repair (bool, optional): Repair the differing chunks.
+        - job (SyncJob, optional): The job which tracks the progress.
+
+        Returns:
+        bool: True if no errors were encountered.
+    """
+
+    job = job or SyncJob(f"verify-{name}")
+    plans, _ = load_plans()
+    plan = next((plan for plan in plans if plan.name == name), None)
+    if plan is None:
+        job.add_errors([f"Sync plan {name} is not defined or not valid"])
+        return False
+
+    errors = []
+    try:
+        job.set_phase(plan.target_table, 'verify')
+        verify_plan(plan, repair, errors, job)
+    except Exception as e:
+        errors.append(f"Error verifying {plan.target_table}: {str(e)}")
+        logs(f"Error verifying {plan.target_table}: {str(e)}", type="error")
+    job.set_phase(plan.target_table, 'failed' if errors else 'done')
+    job.add_errors(errors)
+    return not errors
+
+
+# Example usage: python -m scripts.verify tower_config [--no-repair]
+if __name__ == "__main__":
+    run_verify(sys.argv[1], repair='--no-repair' not in sys.argv)
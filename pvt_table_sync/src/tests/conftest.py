@@ -0,0 +1,42 @@
+import os
+import sys
+import fakeredis
+import fakeredis.aioredis
+import pytest
+
+"""
+    this code lets the tests import the sync scripts without the production services
+    * config builds the database engines when it is imported, the engines connect only when
+      they are used, so placeholder settings are enough for tests which never reach a database
+    * every redis client of the scripts is a fakeredis client of one in-memory server,
+      which is emptied after each test
+"""
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TEST_ENVIRONMENT = {
+    'PRODUCTION_POSTGRES_HOST': 'localhost',
+    'PRODUCTION_POSTGRES_USER': 'test',
+    'PRODUCTION_POSTGRES_PASSWORD': 'test',
+    'PRODUCTION_POSTGRES_DB': 'test',
+    'PRODUCTION_POSTGRES_PORT': '5432',
+    'MYSQL_HOST': 'localhost',
+    'MYSQL_USER': 'test',
+    'MYSQL_PASSWORD': 'test',
+    'REDIS_HOST': 'localhost',
+    'REDIS_PORT': '6379',
+}
+for name, value in TEST_ENVIRONMENT.items():
+    os.environ.setdefault(name, value)
+
+import config  # noqa: E402
+
+redis_server = fakeredis.FakeServer()
+config.redis_con_gp = lambda db: fakeredis.FakeStrictRedis(server=redis_server, db=db)
+config.async_redis_con_gp = lambda db: fakeredis.aioredis.FakeRedis(server=redis_server, db=db)
+
+
+@pytest.fixture(autouse=True)
+def empty_redis():
+    yield
+    fakeredis.FakeStrictRedis(server=redis_server).flushall()
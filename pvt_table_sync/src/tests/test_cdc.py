@@ -0,0 +1,89 @@
+import os
+import sqlite3
+import pytest
+import scripts.cdc as cdc
+import scripts.sync_engine as sync_engine
+from scripts.jobs import SyncJob
+from scripts.leases import acquire
+from scripts.sync_state import get_cdc_position
+
+FIXTURE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fixtures', 'binlog_tariff_config.jsonl')
+
+
+class Source:
+    """The db_office tables after the events of the fixture, read like stream_db_data through sqlite."""
+
+    def __init__(self):
+        self.db = sqlite3.connect(':memory:', check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("ATTACH DATABASE ':memory:' AS db_office")
+        self.db.execute(
+            'CREATE TABLE db_office.tbl_site_initialization (id, site_id, meter_ip, status, timestamp)'
+        )
+        self.db.execute(
+            'CREATE TABLE db_office.tbl_backup_dcu_info (id, meter_address, dg_price, eb_price, dg_full_tariff, eb_full_tariff)'
+        )
+        self.db.execute("INSERT INTO db_office.tbl_site_initialization VALUES (1, 'S1', '10.0.0.1', 1, '2024-05-01 10:00:00')")
+        self.db.execute("INSERT INTO db_office.tbl_backup_dcu_info VALUES (7, '10.0.0.1', 19.0, 8.25, 20, 9)")
+        self.queries = []
+
+    def __call__(self, query, batch_size=None, data_value=(), is_dict=True, server='legacy'):
+        self.queries.append(query)
+        rows = self.db.execute(query.replace('%s', '?'), data_value).fetchall()
+        yield [dict(row) for row in rows]
+
+
+class Target:
+    """The tariff_config table written like merge_rows and delete_rows, the lease tokens are kept."""
+
+    def __init__(self):
+        self.rows = {}
+        self.tokens = []
+
+    def merge_rows(self, rows, target_table, columns, key_column, lease=None, defaults=None):
+        self.tokens.append(lease.token)
+        for row in rows:
+            self.rows[row[columns.index(key_column)]] = dict(zip(columns, row))
+        return len(rows), 0
+
+    def delete_rows(self, target_table, key_column, keys, lease=None):
+        self.tokens.append(lease.token)
+        return sum(self.rows.pop(key, None) is not None for key in keys)
+
+
+@pytest.fixture
+def target(monkeypatch):
+    target = Target()
+    target.rows['10.0.0.2'] = {'meter_ip': '10.0.0.2'}
+    monkeypatch.setattr(cdc, 'stream_db_data', Source())
+    monkeypatch.setattr(sync_engine, 'stream_db_data', cdc.stream_db_data)
+    monkeypatch.setattr(sync_engine, 'merge_rows', target.merge_rows)
+    monkeypatch.setattr(cdc, 'delete_rows', target.delete_rows)
+    return target
+
+
+def test_fixture_replay_writes_the_joined_rows_under_the_table_lease(target):
+    assert cdc.run_cdc('legacy', fixture=FIXTURE, job=SyncJob('test'))
+
+    assert target.rows == {'10.0.0.1': {
+        'site_id': 'S1', 'meter_ip': '10.0.0.1', 'status': 1, 'eb_price': 8.25, 'dg_price': 19.0,
+        'eb_full_tariff': 9, 'dg_full_tariff': 20, 'timestamp': '2024-05-01 10:00:00'
+    }}
+    assert target.tokens and None not in target.tokens
+    # the replay doesn't move the position of the live binlog
+    assert get_cdc_position('legacy') is None
+
+
+def test_replay_waits_for_a_running_sync_of_the_table(target, monkeypatch):
+    sync = acquire('tariff_config')
+    waits = []
+
+    def sleep(seconds):
+        waits.append(seconds)
+        sync.release()
+
+    monkeypatch.setattr(cdc.time, 'sleep', sleep)
+    assert cdc.run_cdc('legacy', fixture=FIXTURE, job=SyncJob('test'))
+
+    assert len(waits) == 1
+    assert min(target.tokens) > sync.token
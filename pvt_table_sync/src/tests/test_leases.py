@@ -0,0 +1,83 @@
+import sqlite3
+import pytest
+import scripts.sync_engine as sync_engine
+from scripts.jobs import SyncJob
+from scripts.leases import plan_shards
+from scripts.sync_engine import SyncPlan
+
+
+class Source:
+    """A db_office.tbl_site_initialization table read like stream_db_data through sqlite."""
+
+    def __init__(self, count):
+        self.db = sqlite3.connect(':memory:', check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("ATTACH DATABASE ':memory:' AS db_office")
+        self.db.execute('CREATE TABLE db_office.tbl_site_initialization (id, site_id, meter_ip, status)')
+        self.add(range(1, count + 1))
+        self.queries = []
+
+    def add(self, keys):
+        self.db.executemany(
+            'INSERT INTO db_office.tbl_site_initialization VALUES (?, ?, ?, ?)',
+            [(key, f"S{key % 3}", f"10.0.0.{key}", '1') for key in keys]
+        )
+
+    def __call__(self, query, batch_size=None, data_value=(), is_dict=True, server='legacy'):
+        self.queries.append(query)
+        rows = self.db.execute(query.replace('%s', '?'), data_value).fetchall()
+        yield [dict(row) for row in rows] if is_dict else [tuple(row) for row in rows]
+
+
+def site_plan(shards):
+    return SyncPlan({
+        'name': 'tariff_config', 'model': 'TariffConfig', 'key_column': 'id', 'shards': shards,
+        'sources': [{
+            'db_name': 'db_office', 'table_name': 'tbl_site_initialization',
+            'select_columns': ['id', 'site_id', 'meter_ip', 'status']
+        }]
+    })
+
+
+@pytest.fixture
+def source(monkeypatch):
+    source = Source(100)
+    monkeypatch.setattr(sync_engine, 'stream_db_data', source)
+    monkeypatch.setattr('scripts.extract.stream_db_data', source)
+    return source
+
+
+def test_shards_are_key_ranges_shared_by_the_round(source):
+    plan = site_plan(3)
+    shards = sorted(plan_shards(plan, 'id'), key=lambda shard: shard.index)
+
+    assert [shard.condition('id') for shard in shards] == ['id < 35', 'id >= 35 AND id < 69', 'id >= 69']
+
+    # a worker joining the round splits the keys the same way, even when rows were added
+    source.add(range(101, 201))
+    joined = sorted(plan_shards(plan, 'id'), key=lambda shard: shard.index)
+    assert [(shard.lo, shard.hi) for shard in joined] == [(shard.lo, shard.hi) for shard in shards]
+
+
+def test_sharded_sync_reads_every_key_once_by_range(source, monkeypatch):
+    written = []
+
+    def merge_rows(rows, target_table, columns, key_column, lease=None, defaults=None):
+        written.extend(row[columns.index(key_column)] for row in rows)
+        return len(rows), 0
+
+    monkeypatch.setattr(sync_engine, 'merge_rows', merge_rows)
+    errors = []
+    sync_engine.sync_plan(site_plan(4), errors, SyncJob('test'))
+
+    assert errors == []
+    assert sorted(written) == list(range(1, 101))
+    reads = [query for query in source.queries if 'MIN(' not in query]
+    assert len(reads) == 4
+    assert all('CRC32' not in query and ('id < ' in query or 'id >= ' in query) for query in reads)
+
+
+def test_shards_of_a_text_key_are_synced_as_one(source):
+    plan = site_plan(3)
+    plan.key_column = 'meter_ip'
+    assert plan_shards(plan, 'meter_ip') == [None]
@@ -0,0 +1,34 @@
+from prometheus_client import REGISTRY
+import scripts.sync_engine as sync_engine
+from scripts.jobs import SyncJob, run_job
+from scripts.leases import acquire
+from scripts.scheduler import TableSchedule
+
+
+def failures(table):
+    return REGISTRY.get_sample_value('table_sync_run_failures_total', {'table': table}) or 0.0
+
+
+def test_run_of_a_table_synced_by_another_worker_is_skipped():
+    other_worker = acquire('tower_config')
+    before = failures('tower_config')
+    job = SyncJob('tower_config', tables=['tower_config'])
+    run_job(job, lambda job: sync_engine.run_plans(None, job=job, name='tower_config'))
+    other_worker.release()
+
+    assert job.status == 'skipped'
+    assert job.errors == []
+    assert job.tables == {'tower_config': 'skipped'}
+    assert failures('tower_config') == before
+
+
+def test_skipped_runs_dont_change_the_interval():
+    schedule = TableSchedule('tower_config', ['tower_config'], {'interval': 600})
+    job = SyncJob('tower_config', tables=['tower_config'])
+    job.status = 'skipped'
+    schedule.adapt(job)
+    assert (schedule.interval, schedule.runs, schedule.last_status) == (600, 0, 'skipped')
+
+    job.status = 'failed'
+    schedule.adapt(job)
+    assert (schedule.interval, schedule.runs) == (1200, 1)
@@ -0,0 +1,188 @@
+import re
+from datetime import datetime
+import pytest
+import scripts.sync_engine as sync_engine
+from scripts.jobs import SyncJob
+from scripts.sync_engine import SyncPlan
+from scripts.sync_state import get_checkpoint, get_watermark
+
+
+TOWER_COLUMNS = ['site_id', 'site_name', 'load_type', 'email', 'contact', 'project', 'gst_no', 'address', 'updated']
+
+
+def tower_rows(count):
+    return [
+        dict(
+            site_id=f"s{index:02d}", site_name=f"site {index}", load_type='a', email='e', contact='c',
+            project='p', gst_no='g', address='a', updated=datetime(2024, 1, 1, index)
+        )
+        for index in range(count)
+    ]
+
+
+class Source:
+    """A source table read like stream_db_data, only the selected columns are returned, the queries are kept."""
+
+    def __init__(self, rows, batch_size=2):
+        self.rows = rows
+        self.batch_size = batch_size
+        self.queries = []
+
+    def __call__(self, query, batch_size=None, data_value=(), is_dict=True, server='legacy'):
+        self.queries.append((query, data_value))
+        rows = sorted(self.rows, key=lambda row: row['site_id'])
+        if 'site_id > %s' in query:
+            rows = [row for row in rows if row['site_id'] > data_value[-1]]
+        columns = re.match(r"SELECT (.*?) FROM", query).group(1)
+        if columns != '*':
+            rows = [{column: row[column] for column in columns.split(', ')} for row in rows]
+        for start in range(0, len(rows), self.batch_size):
+            yield rows[start:start + self.batch_size]
+
+
+class Target:
+    """A target table written like merge_rows, a batch can be made to fail."""
+
+    def __init__(self, fail_on=()):
+        self.rows = {}
+        self.calls = 0
+        self.fail_on = fail_on
+
+    def __call__(self, rows, target_table, columns, key_column, lease=None, defaults=None):
+        self.calls += 1
+        if self.calls in self.fail_on:
+            raise RuntimeError('the target is not reachable')
+        key_index = columns.index(key_column)
+        inserted = sum(row[key_index] not in self.rows for row in rows)
+        self.rows.update((row[key_index], row) for row in rows)
+        return inserted, len(rows) - inserted
+
+
+def tower_plan(**definition):
+    return SyncPlan(dict({
+        'name': 'tower_config', 'model': 'TowerConfig', 'key_column': 'site_id',
+        'sources': [{
+            'db_name': 'db_office', 'table_name': 're_developer_config',
+            'select_columns': TOWER_COLUMNS, 'watermark_column': 'updated'
+        }]
+    }, **definition))
+
+
+@pytest.fixture
+def source(monkeypatch):
+    source = Source(tower_rows(10))
+    monkeypatch.setattr(sync_engine, 'stream_db_data', source)
+    return source
+
+
+def test_failed_run_resumes_from_its_checkpoint(monkeypatch, source):
+    plan = tower_plan(checkpoint=True)
+    failing = Target(fail_on=(3,))
+    monkeypatch.setattr(sync_engine, 'merge_rows', failing)
+    errors = []
+    sync_engine.sync_plan(plan, errors, SyncJob('test'))
+
+    assert errors and len(failing.rows) == 4
+    checkpoint = get_checkpoint('tower_config')
+    assert checkpoint['last_key'] == 's03'
+    assert checkpoint['watermark'] == datetime(2024, 1, 1, 3)
+    assert get_watermark('db_office.re_developer_config') is None
+
+    target = Target()
+    monkeypatch.setattr(sync_engine, 'merge_rows', target)
+    errors = []
+    sync_engine.sync_plan(plan, errors, SyncJob('test'))
+
+    assert errors == []
+    assert source.queries[-1][1][-1] == 's03'
+    assert sorted(target.rows) == [f"s{index:02d}" for index in range(4, 10)]
+    assert get_checkpoint('tower_config') is None
+    assert get_watermark('db_office.re_developer_config') == str(datetime(2024, 1, 1, 9))
+
+
+def fanout_definition():
+    return {
+        'name': 'site_configs', 'key_column': 'site_id',
+        'sources': [{
+            'db_name': 'db_office', 'table_name': 're_developer_config',
+            'select_columns': ['site_id', 'site_name', 'nam', 'meter_ip', 'status', 'remarks'],
+            'watermark_column': 'updated'
+        }],
+        'targets': [
+            {'model': 'TowerConfig', 'column_mapping': {'site_id': 'site_id', 'site_name': 'site_name', 'nam': 'tower_name'}},
+            {'model': 'TariffConfig', 'key_column': 'meter_ip'}
+        ]
+    }
+
+
+def site_rows(count):
+    return [
+        dict(site_id=f"s{index:02d}", site_name=f"site {index}", nam=f"tower {index}", meter_ip=f"ip{index}",
+             status='1', remarks='not synced', updated=datetime(2024, 1, 1, index))
+        for index in range(count)
+    ]
+
+
+def test_fanout_reader_reads_the_columns_of_mapped_and_unmapped_targets():
+    tower, tariff = sync_engine.fanout_plans(fanout_definition())
+    reader = tower.reader
+
+    assert reader.query == (
+        'SELECT site_id, site_name, nam, meter_ip, status, updated FROM db_office.re_developer_config'
+    )
+    assert tower.target_columns == ('site_id', 'site_name', 'tower_name')
+    assert tariff.source_columns == ('site_id', 'meter_ip', 'status')
+
+
+def test_fanout_syncs_mapped_and_unmapped_targets_from_one_read(monkeypatch):
+    source = Source(site_rows(5))
+    monkeypatch.setattr(sync_engine, 'stream_db_data', source)
+    targets = {}
+
+    def merge_rows(rows, target_table, columns, key_column, lease=None, defaults=None):
+        targets.setdefault(target_table, {}).update((row[columns.index(key_column)], dict(zip(columns, row))) for row in rows)
+        return len(rows), 0
+
+    monkeypatch.setattr(sync_engine, 'merge_rows', merge_rows)
+    errors = []
+    sync_engine.sync_fanout(sync_engine.fanout_plans(fanout_definition()), errors, SyncJob('test'))
+
+    assert errors == []
+    assert len(source.queries) == 1
+    assert targets['tower_config']['s03']['tower_name'] == 'tower 3'
+    assert targets['tariff_config']['ip3'] == {'site_id': 's03', 'meter_ip': 'ip3', 'status': '1'}
+    assert get_watermark('db_office.re_developer_config') == str(datetime(2024, 1, 1, 4))
+
+
+def test_failing_fanout_target_does_not_stop_the_others(monkeypatch):
+    monkeypatch.setattr(sync_engine, 'stream_db_data', Source(site_rows(6)))
+    target = Target()
+    monkeypatch.setattr(sync_engine, 'merge_rows', target)
+    tower, tariff = sync_engine.fanout_plans(fanout_definition())
+    batches = []
+
+    def to_rows(records):
+        batches.append(records)
+        if len(batches) == 2:
+            raise ValueError('a bad row')
+        return sync_engine.SyncPlan.to_rows(tariff, records)
+
+    monkeypatch.setattr(tariff, 'to_rows', to_rows)
+    errors = []
+    job = SyncJob('test')
+    sync_engine.sync_fanout([tower, tariff], errors, job)
+
+    assert errors == [f"Error syncing {tariff.name}: a bad row"]
+    assert len(batches) == 2
+    assert job.tables == {'tower_config': 'done', 'tariff_config': 'failed'}
+    assert sorted(target.rows) == ['ip0', 'ip1'] + [f"s{index:02d}" for index in range(6)]
+    assert get_watermark('db_office.re_developer_config') is None
+
+
+def test_plan_file_compiles_and_skips_disabled_plans():
+    plans, broken = sync_engine.load_plans()
+
+    assert broken == []
+    assert 'user_meter_detail' not in [plan.name for plan in plans]
+    # the combine plan joins its sources in one mysql query
+    assert next(plan for plan in plans if plan.name == 'tariff_config').pushdown
@@ -0,0 +1,21 @@
+from datetime import date, datetime
+from decimal import Decimal
+import scripts.sync_state as sync_state
+
+
+def test_checkpoint_watermark_keeps_its_type():
+    checkpoint = sync_state.start_checkpoint('tower_config', ranges=[(1, 10)])
+    checkpoint['watermark'] = datetime(2024, 1, 1, 12, 30)
+    checkpoint['last_key'] = Decimal('1.5')
+    checkpoint['started_on'] = date(2024, 1, 1)
+    sync_state.save_checkpoint('tower_config', checkpoint)
+
+    resumed = sync_state.get_checkpoint('tower_config')
+    assert resumed == checkpoint
+    records = [{'timestamp': datetime(2024, 1, 1, 13, 0)}]
+    assert sync_state.max_watermark(records, 'timestamp', resumed['watermark']) == datetime(2024, 1, 1, 13, 0)
+
+
+def test_text_watermark_of_an_old_checkpoint_is_compared_as_a_datetime():
+    records = [{'timestamp': datetime(2024, 1, 1, 11, 0)}]
+    assert sync_state.max_watermark(records, 'timestamp', '2024-01-01 12:30:00') == datetime(2024, 1, 1, 12, 30)
@@ -0,0 +1,185 @@
+import zlib
+from bisect import bisect_right
+import pytest
+import scripts.sync_engine as sync_engine
+import scripts.verify as verify
+from scripts.leases import acquire
+from scripts.sync_engine import SyncPlan
+
+
+class Table(verify.Side):
+    """
+        A side of a plan whose rows are kept in memory, the chunks are checked in python instead of SQL.
+
+        Parameters:
+        - plan (SyncPlan): The plan of the table.
+        - rows (dict): key: row.
+        - order (function, optional): The sort key of the key collation.
+        - copies (dict, optional): key: how often the key is in the table.
+    """
+
+    def __init__(self, plan, rows, order=None, copies=None):
+        self.plan = plan
+        self.rows = dict(rows)
+        self.order = order or (lambda key: key)
+        self.copies = copies or {}
+
+    def in_chunk(self, key, chunk):
+        order = self.order
+        return (chunk.lo is None or order(key) >= order(chunk.lo)) and (chunk.hi is None or order(key) < order(chunk.hi))
+
+    def chunk_keys(self, chunk):
+        keys = sorted((key for key in self.rows if self.in_chunk(key, chunk)), key=self.order)
+        return [key for key in keys for _ in range(self.copies.get(key, 1))]
+
+    def key_bounds(self):
+        return (min(self.rows), max(self.rows)) if self.rows else (None, None)
+
+    def checksums(self, chunk):
+        sums = {}
+        for key in self.chunk_keys(chunk):
+            if isinstance(chunk, verify.KeyRange):
+                bucket = (key - chunk.lo) // chunk.width
+            else:
+                bucket = bisect_right([self.order(bound) for bound in chunk.bounds or []], self.order(key))
+            count, total = sums.get(bucket, (0, 0))
+            sums[bucket] = (count + 1, total + zlib.crc32(repr(self.rows[key]).encode()))
+        return sums
+
+    def keys(self, chunk):
+        return self.chunk_keys(chunk)
+
+    def existing(self, keys):
+        return [key for key in keys if key in self.rows]
+
+    def boundaries(self, chunk, fanout):
+        keys = self.chunk_keys(chunk)
+        return [key for n, key in enumerate(keys, start=1) if n > 1 and (n - 1) * fanout % len(keys) < fanout]
+
+    def records(self, chunk):
+        yield [dict(zip(self.plan.source_columns, self.rows[key])) for key in self.chunk_keys(chunk)]
+
+
+def site_plan(key_column='id'):
+    return SyncPlan({
+        'name': 'tariff_config', 'model': 'TariffConfig', 'key_column': key_column,
+        'sources': [{
+            'db_name': 'db_office', 'table_name': 'tbl_site_initialization',
+            'select_columns': ['id', 'site_id', 'meter_ip', 'status']
+        }]
+    })
+
+
+def site_rows(keys):
+    return {key: (key, f"S{key % 7}", f"10.0.{key // 250}.{key % 250}", '1') for key in keys}
+
+
+def text_rows(rows):
+    return {row[2]: row for row in rows.values()}
+
+
+def use_tables(monkeypatch, source, target):
+    """Verify the plan of the tables between them, the repairs are written to the target one."""
+    plan = source.plan
+    tokens = []
+
+    def merge_rows(rows, target_table, columns, key_column, lease=None, defaults=None):
+        tokens.append(lease.token)
+        target.rows.update((row[plan.key_index], row) for row in rows)
+        return 0, len(rows)
+
+    def delete_rows(target_table, key_column, keys, lease=None):
+        tokens.append(lease.token)
+        for key in keys:
+            target.rows.pop(key)
+        return len(keys)
+
+    monkeypatch.setattr(verify, 'Side', lambda plan, dialect: source if dialect == 'mysql' else target)
+    monkeypatch.setattr(sync_engine, 'merge_rows', merge_rows)
+    monkeypatch.setattr(verify, 'delete_rows', delete_rows)
+    monkeypatch.setattr(verify, 'SYNC_VERIFY_LEAF_ROWS', 20)
+    return tokens
+
+
+@pytest.fixture
+def tables(monkeypatch):
+    plan = site_plan()
+    source = Table(plan, site_rows(range(1, 3001)))
+    target = Table(plan, site_rows(range(1, 3001)))
+    return plan, source, target, use_tables(monkeypatch, source, target)
+
+
+def test_repair_writes_under_the_table_lease(tables):
+    plan, source, target, tokens = tables
+    target.rows[17] = (17, 'S0', 'changed', '1')
+    del target.rows[2500]
+    target.rows[5000] = (5000, 'S0', 'extra', '1')
+
+    errors = []
+    report = verify.verify_plan(plan, errors=errors)
+
+    assert errors == []
+    assert target.rows == source.rows
+    assert report['rows_deleted'] == 1
+    assert tokens and None not in tokens
+    assert verify.verify_plan(plan)['mismatched_chunks'] == []
+
+
+def test_no_repair_while_a_sync_holds_the_table(tables):
+    plan, source, target, tokens = tables
+    target.rows[17] = (17, 'S0', 'changed', '1')
+    sync = acquire('tariff_config')
+
+    errors = []
+    report = verify.verify_plan(plan, errors=errors)
+    sync.release()
+
+    assert errors == ["tariff_config is syncing on another worker, it can't be repaired now"]
+    assert report['rows_repaired'] == 0 and tokens == []
+    assert verify.verify_plan(plan, repair=False)['mismatched_chunks'] == ['[13, 25)']
+
+
+def test_text_keys_are_split_into_sampled_ranges_until_the_differing_rows_are_found(monkeypatch):
+    plan = site_plan('meter_ip')
+    source = Table(plan, text_rows(site_rows(range(1, 3001))))
+    target = Table(plan, text_rows(site_rows(range(1, 3001))))
+    use_tables(monkeypatch, source, target)
+    target.rows['10.0.4.17'] = (1017, 'S2', '10.0.4.17', '0')
+    del target.rows['10.0.9.200']
+
+    report = verify.verify_plan(plan, repair=False)
+
+    assert len(report['mismatched_chunks']) == 2
+    # only the rows of the two small chunks are written again
+    assert verify.verify_plan(plan)['rows_repaired'] <= 40
+    assert target.rows == source.rows
+
+
+def test_repeated_keys_stop_the_split(monkeypatch):
+    plan = site_plan('meter_ip')
+    source = Table(plan, text_rows(site_rows(range(1, 301))))
+    target = Table(plan, text_rows(site_rows(range(1, 301))), copies={'10.0.0.50': 100})
+    use_tables(monkeypatch, source, target)
+
+    report = verify.verify_plan(plan, repair=False)
+
+    # every boundary sampled from the chunk is the repeated key
+    assert report['mismatched_chunks'] == ["['10.0.0.50', '10.0.0.55')"]
+
+
+def test_keys_ordered_differently_by_the_source_are_not_deleted(monkeypatch):
+    plan = site_plan('meter_ip')
+    # a case insensitive source collation sorts 'M2' between 'm1' and 'm3', binary order puts it before them
+    rows = {}
+    for key in range(1, 301):
+        meter_ip = f"M{key:03d}" if key % 2 else f"m{key:03d}"
+        rows[meter_ip] = (key, 'S1', meter_ip, '1')
+    source = Table(plan, rows, order=str.lower)
+    target = Table(plan, rows)
+    use_tables(monkeypatch, source, target)
+    target.rows['M007'] = (7, 'S1', 'M007', '0')
+
+    report = verify.verify_plan(plan)
+
+    assert report['rows_deleted'] == 0
+    assert target.rows == source.rows
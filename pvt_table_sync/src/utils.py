@@ -1,5 +1,12 @@
+import atexit
+import os
+import queue
+import random
+import threading
 import requests
 import logging
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener
 from config import redis_con_gp
 from fastapi import HTTPException, status
 from datetime import datetime
@@ -28,6 +35,37 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'  # Set the date format for log timestamps
 )
 
+# the records are put on a queue and written by a background thread, so logging never waits for
+# the console or a file in the sync loops
+log_queue = queue.SimpleQueue()
+root_logger = logging.getLogger()
+log_listeners = [QueueListener(log_queue, *root_logger.handlers, respect_handler_level=True)]
+root_logger.handlers = [QueueHandler(log_queue)]
+log_listeners[0].start()
+
+
+def stop_log_listeners():
+    """Write the queued records before the process exits."""
+    for listener in log_listeners:
+        listener.stop()
+
+
+atexit.register(stop_log_listeners)
+
+SUCCESS = 25
+logging.addLevelName(SUCCESS, 'SUCCESS')
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'success': SUCCESS,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'critical': logging.CRITICAL
+}
+# share of the rows whose insert / update gets its own log line, 0 logs only the totals
+ROW_LOG_SAMPLE = float(os.environ.get('ROW_LOG_SAMPLE', 0))
+
+logger = logging.getLogger(__name__)
 loggers = {}
 
 
@@ -56,7 +94,12 @@ def setup_logger(log_filename):
     file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(formatter)
 
-    _logger.addHandler(file_handler)
+    # the file is written by its own background thread
+    file_queue = queue.SimpleQueue()
+    listener = QueueListener(file_queue, file_handler)
+    listener.start()
+    log_listeners.append(listener)
+    _logger.addHandler(QueueHandler(file_queue))
 
     loggers[log_filename] = _logger
     return _logger
@@ -64,12 +107,14 @@ def setup_logger(log_filename):
 
 def logs(msg='', type='info', file_name=''):
     """
-        Log messages with different log levels (debug, info, warning, error, critical).
+        Log messages with different log levels (debug, info, success, warning, error, critical).
+
+        The record is only put on the log queue, a background thread writes it.
 
         Parameters:
         - msg (str, optional): The message to be logged. Defaults to an empty string.
-        - type (str, optional): The log level/type (debug, info, warning, error, critical).
-        Defaults to 'info'.
+        - type (str, optional): The log level/type (debug, info, success, warning, error, critical).
+        Defaults to 'info', an unknown type is logged as info.
         - file_name (str, optional): The name of the log file. If provided,
         a new logger will be set up for that file.
 
@@ -77,20 +122,41 @@ def logs(msg='', type='info', file_name=''):
         None: The function logs the specified message at the specified log level.
     """
 
-    logger = logging.getLogger(__name__)
-    if file_name:
-        logger = setup_logger(file_name)
-
-    if type == 'debug':
-        logger.debug(msg)
-    if type == 'info':
-        logger.info(msg)
-    if type == 'warning':
-        logger.warning(msg)
-    if type == 'error':
-        logger.error(msg)
-    if type == 'critical':
-        logger.critical(msg)
+    _logger = setup_logger(file_name) if file_name else logger
+    _logger.log(LOG_LEVELS.get(type, logging.INFO), msg)
+
+
+class RowCounts:
+    """
+        Count the rows written per table and action instead of logging every row.
+
+        row_counts.add('tower_config', 'updated', 120) only counts the rows, row_counts.sample logs
+        a ROW_LOG_SAMPLE share of their keys, row_counts.flush('tower_config') logs the totals once.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, table, action, count):
+        if not count:
+            return
+        with self.lock:
+            self.counts.setdefault(table, Counter())[action] += count
+
+    def sample(self, table, action, keys, key_column):
+        if keys and ROW_LOG_SAMPLE:
+            for key in random.sample(keys, min(len(keys), round(len(keys) * ROW_LOG_SAMPLE))):
+                logs(f"{action.capitalize()} record with {key_column} {key} in {table}")
+
+    def flush(self, table):
+        with self.lock:
+            counts = self.counts.pop(table, None)
+        if counts:
+            logs(f"{table}: " + ', '.join(f"{count} rows {action}" for action, count in sorted(counts.items())))
+
+
+row_counts = RowCounts()
 def array_to_tupple(item):
         return tuple(item) if len(item) > 1 else f"('{item[0]}')"
 